@@ -1,24 +1,57 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, File, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import JSONResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, CursorType, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import CollectionInvalid, OperationFailure
+from bson import Timestamp
 import os
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from typing import List, Optional, Dict, Any, Callable, Awaitable, Set
 import uuid
-from datetime import datetime, timedelta, time
+import hashlib
+import hmac
+import base64
+from datetime import datetime, timedelta, time, timezone
 import jwt
 from passlib.context import CryptContext
 import re
+import bisect
+from collections import OrderedDict, deque
+import weakref
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
 import json
 import aiofiles
 import mimetypes
-from urllib.parse import quote
+from urllib.parse import quote, urlencode
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Image thumbnails are skipped without Pillow
+    Image = None
+
+try:
+    import orjson
+except ImportError:  # WebSocket payloads fall back to the stdlib encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # Chat sockets only offer JSON without msgpack
+    msgpack = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -33,9 +66,36 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production'
 JWT_ALGORITHM = 'HS256'
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
 
+# Chat settings
+CHAT_BROKER = os.environ.get('CHAT_BROKER', 'local')  # local or mongo
+CHAT_EVENTS_COLLECTION_BYTES = int(os.environ.get('CHAT_EVENTS_COLLECTION_BYTES', str(16 * 1024 * 1024)))
+UNREAD_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('UNREAD_RECONCILE_INTERVAL_SECONDS', '3600'))
+BLOB_GC_INTERVAL_SECONDS = int(os.environ.get('BLOB_GC_INTERVAL_SECONDS', '3600'))
+BLOB_GC_GRACE_SECONDS = int(os.environ.get('BLOB_GC_GRACE_SECONDS', '3600'))
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', '2'))
+READ_RECEIPT_FLUSH_INTERVAL_SECONDS = float(os.environ.get('READ_RECEIPT_FLUSH_INTERVAL_SECONDS', '1.0'))
+READ_RECEIPT_BATCH_SIZE = int(os.environ.get('READ_RECEIPT_BATCH_SIZE', '100'))
+PRESENCE_HEARTBEAT_SECONDS = int(os.environ.get('PRESENCE_HEARTBEAT_SECONDS', '30'))
+PRESENCE_TIMEOUT_SECONDS = int(os.environ.get('PRESENCE_TIMEOUT_SECONDS', '90'))
+UPLOAD_URL_TTL_SECONDS = int(os.environ.get('UPLOAD_URL_TTL_SECONDS', '3600'))
+UPLOAD_URL_SECRET = os.environ.get('UPLOAD_URL_SECRET', JWT_SECRET)
+WS_TICKET_TTL_SECONDS = int(os.environ.get('WS_TICKET_TTL_SECONDS', '60'))
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '256'))
+WS_SEND_OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+WS_SEND_OVERFLOW_POLICY = os.environ.get('WS_SEND_OVERFLOW_POLICY', 'drop_oldest').replace('-', '_')
+if WS_SEND_OVERFLOW_POLICY not in WS_SEND_OVERFLOW_POLICIES:
+    raise ValueError(f"WS_SEND_OVERFLOW_POLICY must be one of {', '.join(WS_SEND_OVERFLOW_POLICIES)}")
+
+# Authenticated user cache settings
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', '10000'))
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '64'))
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 # Create the main app without a prefix
 app = FastAPI(title="DocEase Healthcare Platform", version="1.0.0")
@@ -182,6 +242,8 @@ class DoctorProfileResponse(BaseModel):
     # New fields for enhanced search
     distance: Optional[float] = None  # Distance from user location
     has_current_availability: Optional[bool] = None  # Has slots available soon
+    is_online: bool = False  # Has an open chat connection
+    last_seen: Optional[datetime] = None
 
 # Availability Models
 class TimeSlot(BaseModel):
@@ -292,6 +354,8 @@ class ChatMessage(BaseModel):
     file_url: Optional[str] = None
     file_name: Optional[str] = None
     file_size: Optional[int] = None
+    file_hash: Optional[str] = None  # SHA-256 of the file contents
+    thumbnail_urls: Dict[str, str] = {}  # Image previews by size label
     status: MessageStatus = MessageStatus.SENT
     created_at: datetime = Field(default_factory=datetime.utcnow)
     read_at: Optional[datetime] = None
@@ -306,12 +370,15 @@ class ChatMessageResponse(BaseModel):
     file_url: Optional[str] = None
     file_name: Optional[str] = None
     file_size: Optional[int] = None
+    thumbnail_urls: Dict[str, str] = {}
     status: MessageStatus
     created_at: datetime
     read_at: Optional[datetime] = None
     # Sender info
     sender_name: Optional[str] = None
     sender_role: Optional[UserRole] = None
+    # Query string that grants the viewer access to file_url and its thumbnails
+    file_access: Optional[str] = None
 
 class ChatConversation(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -319,6 +386,7 @@ class ChatConversation(BaseModel):
     appointment_id: Optional[str] = None
     last_message_id: Optional[str] = None
     last_message_at: Optional[datetime] = None
+    unread_counts: Dict[str, int] = {}  # Unread messages per participant ID
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_active: bool = True
 
@@ -334,6 +402,8 @@ class ChatConversationResponse(BaseModel):
     # Participant info
     other_participant_name: Optional[str] = None
     other_participant_role: Optional[UserRole] = None
+    other_participant_online: bool = False
+    other_participant_last_seen: Optional[datetime] = None
 
 class SendMessageRequest(BaseModel):
     receiver_id: str
@@ -341,43 +411,1061 @@ class SendMessageRequest(BaseModel):
     content: str
     appointment_id: Optional[str] = None
 
-# WebSocket Connection Manager
-class ConnectionManager:
+# Database indexes
+# Every index the application relies on, keyed by collection. Missing ones are
+# created on startup and drift is reported by GET /api/admin/indexes.
+DATABASE_INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("role", ASCENDING)]),
+    ],
+    "doctor_profiles": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("specializations", ASCENDING)]),
+        IndexModel([("clinic_info.city", ASCENDING)]),
+        IndexModel(
+            [
+                ("user_name", TEXT),
+                ("specializations", TEXT),
+                ("qualifications", TEXT),
+                ("clinic_info.name", TEXT),
+                ("bio", TEXT),
+            ],
+            name="doctor_search_text",
+            weights={"user_name": 10, "specializations": 8, "clinic_info.name": 5, "qualifications": 3, "bio": 1},
+        ),
+    ],
+    "availability_slots": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("doctor_id", ASCENDING), ("date", ASCENDING)]),
+    ],
+    "appointments": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("patient_id", ASCENDING), ("appointment_date", ASCENDING)]),
+        IndexModel([("doctor_id", ASCENDING), ("appointment_date", ASCENDING)]),
+        IndexModel([("availability_slot_id", ASCENDING)]),
+        IndexModel([("status", ASCENDING)]),
+    ],
+    "chat_conversations": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("participants", ASCENDING)]),
+        IndexModel([("last_message_at", DESCENDING)]),
+    ],
+    "file_blobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("ref_count", ASCENDING), ("released_at", ASCENDING)]),
+    ],
+    "chat_messages": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("conversation_id", ASCENDING)]),
+        IndexModel([("conversation_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("receiver_id", ASCENDING), ("status", ASCENDING)]),
+        IndexModel([("file_url", ASCENDING)], partialFilterExpression={"file_url": {"$type": "string"}}),
+    ],
+    "user_presence": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("workers", ASCENDING)]),
+    ],
+    "presence_workers": [
+        IndexModel([("worker_id", ASCENDING)], unique=True),
+        IndexModel([("seen_at", ASCENDING)]),
+    ],
+}
+
+# Chat event brokers
+# A broker relays notifications between worker processes so that a message
+# reaches the receiver whichever worker holds their WebSocket. Control events
+# (such as a changed user) are broadcast to every other worker.
+DeliverCallback = Callable[[str, bytes], Awaitable[bool]]
+ControlCallback = Callable[[dict], Awaitable[None]]
+
+class LocalBroker:
+    """In-process broker.
+
+    Relays between ConnectionManagers that share this instance, so a single
+    worker needs nothing else and tests can simulate several workers.
+    """
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logger.info(f"User {user_id} connected to chat")
+        self._subscribers: Dict[str, tuple] = {}
+    
+    async def start(self, worker_id: str, deliver: DeliverCallback, control: ControlCallback):
+        self._subscribers[worker_id] = (deliver, control)
+    
+    async def publish(self, worker_id: str, user_id: str, payload: bytes):
+        for subscriber_id, (deliver, _) in list(self._subscribers.items()):
+            if subscriber_id != worker_id:
+                await deliver(user_id, payload)
+    
+    async def broadcast(self, worker_id: str, event: dict):
+        for subscriber_id, (_, control) in list(self._subscribers.items()):
+            if subscriber_id != worker_id:
+                await control(event)
+    
+    async def stop(self, worker_id: str):
+        self._subscribers.pop(worker_id, None)
+
+class MongoBroker:
+    """Broker backed by a capped MongoDB collection.
+
+    Every worker appends events to the collection and tails it with a
+    tailable cursor, delivering events published by other workers.
+    """
+    def __init__(self, database, collection_name: str = "chat_events", size_bytes: int = CHAT_EVENTS_COLLECTION_BYTES):
+        self.database = database
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def collection(self):
+        return self.database[self.collection_name]
+    
+    async def start(self, worker_id: str, deliver: DeliverCallback, control: ControlCallback):
+        try:
+            await self.database.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+        except CollectionInvalid:
+            pass  # Already created by another worker
+        self._task = asyncio.create_task(self._tail(worker_id, deliver, control))
+    
+    async def publish(self, worker_id: str, user_id: str, payload: bytes):
+        # Events carry the encoded payload so receiving workers don't re-serialize
+        await self.collection.insert_one({
+            "seq": Timestamp(0, 0),
+            "origin": worker_id,
+            "user_id": user_id,
+            "payload": payload,
+            "created_at": datetime.utcnow()
+        })
     
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            logger.info(f"User {user_id} disconnected from chat")
+    async def broadcast(self, worker_id: str, event: dict):
+        await self.collection.insert_one({
+            "seq": Timestamp(0, 0),
+            "origin": worker_id,
+            "control": event,
+            "created_at": datetime.utcnow()
+        })
     
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
+    async def stop(self, worker_id: str):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+    
+    async def _tail(self, worker_id: str, deliver: DeliverCallback, control: ControlCallback):
+        # The server replaces the empty "seq" timestamp on insert with a value
+        # that increases in insertion order, unlike client-generated ObjectIds,
+        # so re-tailing from the last seq seen neither skips nor replays events.
+        # Only relay events published after this worker started.
+        latest = await self.collection.find_one({}, {"seq": 1}, sort=[("$natural", -1)])
+        last_seq = (latest or {}).get("seq", Timestamp(0, 0))
+        while True:
             try:
-                await self.active_connections[user_id].send_text(json.dumps(message))
-                return True
+                cursor = self.collection.find({"seq": {"$gt": last_seq}}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for event in cursor:
+                        last_seq = event["seq"]
+                        if event["origin"] == worker_id:
+                            continue
+                        if "control" in event:
+                            await control(event["control"])
+                        else:
+                            await deliver(event["user_id"], bytes(event["payload"]))
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"Error sending message to {user_id}: {e}")
-                self.disconnect(user_id)
+                logger.error(f"Chat event broker error: {e}")
+            # The cursor dies when the collection is empty; wait before re-tailing
+            await asyncio.sleep(1)
+
+# Presence
+# A user is online while at least one worker holds a socket for them. Each
+# user_presence document lists those workers; workers heartbeat into
+# presence_workers so entries left behind by a crashed worker can be pruned.
+class PresenceRegistry:
+    def __init__(self, database):
+        self.database = database
+    
+    async def touch_worker(self, worker_id: str):
+        await self.database.presence_workers.update_one(
+            {"worker_id": worker_id},
+            {"$set": {"seen_at": datetime.utcnow()}},
+            upsert=True
+        )
+    
+    async def remove_worker(self, worker_id: str):
+        await self.database.presence_workers.delete_one({"worker_id": worker_id})
+    
+    async def mark_online(self, user_id: str, worker_id: str) -> bool:
+        """Add the worker to the user's entry; True if the user just came online."""
+        before = await self.database.user_presence.find_one_and_update(
+            {"user_id": user_id},
+            {"$addToSet": {"workers": worker_id}, "$set": {"online": True}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        return not (before and before.get("online"))
+    
+    async def mark_offline(self, user_id: str, worker_id: str) -> Optional[datetime]:
+        """Remove the worker from the user's entry; returns last_seen if the user went offline."""
+        # One pipeline update, so a concurrent connect can't slip in between
+        # removing the worker and flipping the status
+        last_seen = datetime.utcnow()
+        remaining = {"$filter": {"input": {"$ifNull": ["$workers", []]}, "cond": {"$ne": ["$$this", worker_id]}}}
+        still_online = {"$gt": [{"$size": remaining}, 0]}
+        before = await self.database.user_presence.find_one_and_update(
+            {"user_id": user_id},
+            [{"$set": {
+                "workers": remaining,
+                "online": still_online,
+                "last_seen": {"$cond": [still_online, "$last_seen", last_seen]}
+            }}],
+            return_document=ReturnDocument.BEFORE
+        )
+        went_offline = before and before.get("online") and not set(before.get("workers", [])) - {worker_id}
+        return last_seen if went_offline else None
+    
+    async def _settle_offline(self, user_id: str) -> Optional[datetime]:
+        # Only flips when no worker holds a socket, so a concurrent connect wins
+        last_seen = datetime.utcnow()
+        result = await self.database.user_presence.update_one(
+            {"user_id": user_id, "online": True, "workers": {"$size": 0}},
+            {"$set": {"online": False, "last_seen": last_seen}}
+        )
+        return last_seen if result.modified_count else None
+    
+    async def prune_dead_workers(self, timeout_seconds: int) -> List[tuple]:
+        """Drop workers that stopped heartbeating; returns (user_id, last_seen) for users now offline."""
+        cutoff = datetime.utcnow() - timedelta(seconds=timeout_seconds)
+        dead_workers = await self.database.presence_workers.find(
+            {"seen_at": {"$lt": cutoff}}, {"_id": 0, "worker_id": 1}
+        ).to_list(None)
+        
+        went_offline = []
+        for worker in dead_workers:
+            worker_id = worker["worker_id"]
+            entries = await self.database.user_presence.find(
+                {"workers": worker_id}, {"_id": 0, "user_id": 1}
+            ).to_list(None)
+            await self.database.user_presence.update_many(
+                {"workers": worker_id},
+                {"$pull": {"workers": worker_id}}
+            )
+            for entry in entries:
+                last_seen = await self._settle_offline(entry["user_id"])
+                if last_seen:
+                    went_offline.append((entry["user_id"], last_seen))
+            await self.remove_worker(worker_id)
+        return went_offline
+    
+    async def partners(self, user_id: str) -> Set[str]:
+        """Users who share an active conversation with ``user_id``."""
+        conversations = await self.database.chat_conversations.find(
+            {"participants": user_id, "is_active": True}, {"_id": 0, "participants": 1}
+        ).to_list(None)
+        return {p for conv in conversations for p in conv["participants"] if p != user_id}
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def encode_ws_message(message: dict) -> bytes:
+    """Serialize a WebSocket event to UTF-8 JSON, once per event."""
+    if orjson is not None:
+        return orjson.dumps(message, default=_json_default)
+    return json.dumps(message, default=_json_default, separators=(",", ":")).encode()
+
+def decode_ws_message(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def encode_ws_msgpack(message: dict) -> bytes:
+    return msgpack.packb(message, default=_json_default)
+
+# Wire formats for chat sockets, negotiated through the WebSocket subprotocol.
+# Clients that offer none get JSON.
+WS_ENCODERS: Dict[str, Callable[[dict], bytes]] = {"json": encode_ws_message}
+WS_SUBPROTOCOLS: Dict[str, str] = {"chat.json": "json"}
+if msgpack is not None:
+    WS_ENCODERS["msgpack"] = encode_ws_msgpack
+    WS_SUBPROTOCOLS["chat.msgpack"] = "msgpack"
+
+class WsPayload:
+    """A WebSocket event, encoded at most once per wire format however many sockets get it."""
+    __slots__ = ("_message", "_encoded")
+    
+    def __init__(self, message: Optional[dict] = None, json_bytes: Optional[bytes] = None):
+        self._message = message
+        self._encoded: Dict[str, bytes] = {}
+        if json_bytes is not None:
+            self._encoded["json"] = json_bytes
+    
+    def encode(self, wire_format: str = "json") -> bytes:
+        encoded = self._encoded.get(wire_format)
+        if encoded is None:
+            if self._message is None:
+                self._message = decode_ws_message(self._encoded["json"])
+            encoded = self._encoded[wire_format] = WS_ENCODERS[wire_format](self._message)
+        return encoded
+
+# WebSocket Connection Manager
+class ChatConnection:
+    """An authenticated chat socket with the user resolved at handshake.
+
+    Outgoing frames go through a bounded queue drained by a writer task, so
+    senders never wait on this client's network.
+    """
+    
+    def __init__(self, websocket: WebSocket, user: User, expires_at: Optional[datetime] = None,
+                 binary: bool = False, wire_format: str = "json", queue_size: int = WS_SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.user = user
+        self.wire_format = wire_format
+        self.binary = binary or wire_format != "json"  # Client reads binary frames
+        self.expires_at = expires_at
+        self.connected_at = datetime.utcnow()
+        self.last_heartbeat = self.connected_at
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._enqueued_at: deque = deque()  # Loop time each queued frame was queued, oldest first
+        self.writer: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+    
+    @property
+    def user_id(self) -> str:
+        return self.user.id
+    
+    def is_expired(self) -> bool:
+        return self.expires_at is not None and datetime.utcnow() >= self.expires_at
+    
+    def heartbeat(self):
+        self.last_heartbeat = datetime.utcnow()
+    
+    def enqueue(self, payload: WsPayload, overflow_policy: str = WS_SEND_OVERFLOW_POLICY) -> bool:
+        """Queue a frame; False if the queue is full and the policy is to disconnect."""
+        if self.queue.full():
+            if overflow_policy == "disconnect":
+                return False
+            self.queue.get_nowait()
+            self._enqueued_at.popleft()
+            self.dropped += 1
+        self.queue.put_nowait(payload)
+        self._enqueued_at.append(asyncio.get_running_loop().time())
+        return True
+    
+    async def next_frame(self) -> tuple:
+        """Wait for the next queued frame and return (enqueued_at, payload)."""
+        payload = await self.queue.get()
+        return self._enqueued_at.popleft(), payload
+    
+    def stats(self) -> dict:
+        oldest_wait = 0.0
+        if self._enqueued_at:
+            oldest_wait = asyncio.get_running_loop().time() - self._enqueued_at[0]
+        return {
+            "user_id": self.user_id,
+            "connected_at": self.connected_at,
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "lag_ms": round(max(self.last_lag, oldest_wait) * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1)
+        }
+
+class ConnectionManager:
+    def __init__(self, broker=None, presence: Optional[PresenceRegistry] = None,
+                 overflow_policy: str = WS_SEND_OVERFLOW_POLICY):
+        if overflow_policy not in WS_SEND_OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow_policy!r}")
+        self.worker_id = str(uuid.uuid4())
+        self.active_connections: Dict[str, Set[ChatConnection]] = {}
+        self.broker = broker or LocalBroker()
+        self.presence = presence
+        self.overflow_policy = overflow_policy
+        self.overflow_disconnects = 0
+        # Users this worker has registered in the presence registry, and a
+        # lock per user so their connects and disconnects update it in order
+        self._announced: Set[str] = set()
+        self._presence_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+    
+    async def start(self):
+        await self.broker.start(self.worker_id, self._deliver_relayed, self._handle_control)
+        if self.presence:
+            await self.presence.touch_worker(self.worker_id)
+    
+    async def stop(self):
+        if self.presence:
+            for user_id in list(self._announced):
+                await self._user_offline(user_id)
+            await self.presence.remove_worker(self.worker_id)
+        for connections in self.active_connections.values():
+            for connection in connections:
+                if connection.writer:
+                    connection.writer.cancel()
+        await self.broker.stop(self.worker_id)
+    
+    async def connect(self, connection: ChatConnection, subprotocol: Optional[str] = None):
+        """Accept and register a socket; pair every call with disconnect()."""
+        await connection.websocket.accept(subprotocol=subprotocol)
+        connection.writer = asyncio.create_task(self._write(connection))
+        self.active_connections.setdefault(connection.user_id, set()).add(connection)
+        logger.info(f"User {connection.user_id} connected to chat")
+        await self._sync_presence(connection.user_id)
+    
+    async def disconnect(self, connection: ChatConnection):
+        self._unregister(connection)
+        await self._sync_presence(connection.user_id)
+    
+    def _unregister(self, connection: ChatConnection) -> bool:
+        """Stop writing to a socket and forget it; False if it was already gone."""
+        if connection.writer and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+        connections = self.active_connections.get(connection.user_id)
+        if not connections or connection not in connections:
+            return False
+        connections.discard(connection)
+        logger.info(f"User {connection.user_id} disconnected from chat")
+        if not connections:
+            del self.active_connections[connection.user_id]
+        return True
+    
+    async def _sync_presence(self, user_id: str):
+        """Bring the registry in line with whether this worker holds a socket for the user.
+
+        Runs under the user's lock and reads local state inside it, so a
+        reconnect racing a disconnect on this worker can't leave the user
+        marked offline.
+        """
+        if not self.presence:
+            return
+        lock = self._presence_locks.get(user_id)
+        if lock is None:
+            lock = self._presence_locks[user_id] = asyncio.Lock()
+        async with lock:
+            connected = user_id in self.active_connections
+            if connected == (user_id in self._announced):
+                return
+            if connected:
+                # Announced first, so a failed write is still undone on disconnect
+                self._announced.add(user_id)
+                if await self.presence.mark_online(user_id, self.worker_id):
+                    await self.notify_presence(user_id, True)
+            else:
+                await self._user_offline(user_id)
+    
+    async def _write(self, connection: ChatConnection):
+        """Drain the connection's queue onto its socket."""
+        try:
+            while True:
+                enqueued_at, payload = await connection.next_frame()
+                data = payload.encode(connection.wire_format)
+                if connection.binary:
+                    await connection.websocket.send_bytes(data)
+                else:
+                    await connection.websocket.send_text(data.decode())
+                connection.sent += 1
+                connection.last_lag = asyncio.get_running_loop().time() - enqueued_at
+                connection.max_lag = max(connection.max_lag, connection.last_lag)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error sending message to {connection.user_id}: {e}")
+            await self.disconnect(connection)
+    
+    async def send(self, connection: ChatConnection, payload: WsPayload) -> bool:
+        """Queue a frame for one socket, applying the overflow policy.
+
+        Never waits on the network or the database, so request handlers only
+        pay for the enqueue.
+        """
+        if connection.enqueue(payload, self.overflow_policy):
+            return True
+        if self._unregister(connection):
+            # The client can't keep up; drop it rather than buffer without bound.
+            # Its presence update and close run in the background.
+            self.overflow_disconnects += 1
+            logger.warning(f"Send queue full for {connection.user_id}, disconnecting")
+            asyncio.create_task(self._drop(connection, status.WS_1013_TRY_AGAIN_LATER))
         return False
+    
+    async def _drop(self, connection: ChatConnection, code: int):
+        await self._sync_presence(connection.user_id)
+        await self._close_quietly(connection, code)
+    
+    @staticmethod
+    async def _close_quietly(connection: ChatConnection, code: int):
+        try:
+            await connection.websocket.close(code=code)
+        except Exception:
+            pass  # Already gone
+    
+    def stats(self) -> dict:
+        connections = [c.stats() for conns in self.active_connections.values() for c in conns]
+        return {
+            "worker_id": self.worker_id,
+            "overflow_policy": self.overflow_policy,
+            "users": len(self.active_connections),
+            "connections": len(connections),
+            "queued": sum(c["queued"] for c in connections),
+            "dropped": sum(c["dropped"] for c in connections),
+            "overflow_disconnects": self.overflow_disconnects,
+            "max_lag_ms": max((c["lag_ms"] for c in connections), default=0.0),
+            "per_connection": sorted(connections, key=lambda c: c["lag_ms"], reverse=True)[:50]
+        }
+    
+    async def _user_offline(self, user_id: str):
+        last_seen = await self.presence.mark_offline(user_id, self.worker_id)
+        self._announced.discard(user_id)
+        if last_seen:
+            await self.notify_presence(user_id, False, last_seen)
+    
+    async def notify_presence(self, user_id: str, online: bool, last_seen: Optional[datetime] = None):
+        """Push a status change to the user's conversation partners."""
+        payload = WsPayload({"type": "presence", "user_id": user_id, "online": online, "last_seen": last_seen})
+        for partner_id in await self.presence.partners(user_id):
+            await self.send_payload(payload, partner_id)
+    
+    async def check_heartbeats(self) -> int:
+        """Close silent sockets, renew this worker's presence and prune dead workers."""
+        cutoff = datetime.utcnow() - timedelta(seconds=PRESENCE_TIMEOUT_SECONDS)
+        stale = [
+            connection
+            for connections in self.active_connections.values()
+            for connection in connections
+            if connection.last_heartbeat < cutoff
+        ]
+        for connection in stale:
+            await self.disconnect(connection)
+            asyncio.create_task(self._close_quietly(connection, status.WS_1001_GOING_AWAY))
+        
+        if not self.presence:
+            return len(stale)
+        await self.presence.touch_worker(self.worker_id)
+        went_offline = await self.presence.prune_dead_workers(PRESENCE_TIMEOUT_SECONDS)
+        for user_id, last_seen in went_offline:
+            await self.notify_presence(user_id, False, last_seen)
+        return len(stale) + len(went_offline)
+    
+    def refresh_user(self, user: User):
+        """Swap in a fresh user on this worker's open sockets after a profile change."""
+        for connection in self.active_connections.get(user.id, ()):
+            connection.user = user
+    
+    async def user_changed(self, user: User):
+        """Refresh the user's sockets and cached copies on every worker."""
+        self.refresh_user(user)
+        user_cache.invalidate_user(user.id)
+        await self.broker.broadcast(self.worker_id, {"type": "user_changed", "user": user.dict()})
+    
+    async def _handle_control(self, event: dict):
+        if event.get("type") == "user_changed":
+            user = User(**event["user"])
+            self.refresh_user(user)
+            user_cache.invalidate_user(user.id)
+        elif event.get("type") == "suggestions_changed":
+            suggestion_index.set_source(event["source_id"], event["suggestions"])
+    
+    async def deliver_local(self, user_id: str, payload: WsPayload) -> bool:
+        """Queue for every socket the user has open on this worker."""
+        delivered = False
+        for connection in list(self.active_connections.get(user_id, ())):
+            delivered = await self.send(connection, payload) or delivered
+        return delivered
+    
+    async def _deliver_relayed(self, user_id: str, data: bytes) -> bool:
+        return await self.deliver_local(user_id, WsPayload(json_bytes=data))
+    
+    async def send_payload(self, payload: WsPayload, user_id: str):
+        """Deliver an event here and relay its JSON encoding to the other workers."""
+        delivered = await self.deliver_local(user_id, payload)
+        await self.broker.publish(self.worker_id, user_id, payload.encode("json"))
+        return delivered
+    
+    async def send_personal_message(self, message: dict, user_id: str):
+        return await self.send_payload(WsPayload(message), user_id)
+
+manager = ConnectionManager(
+    MongoBroker(db) if CHAT_BROKER == 'mongo' else LocalBroker(),
+    PresenceRegistry(db)
+)
 
-manager = ConnectionManager()
+# Autocomplete index for doctor search suggestions
+class SuggestionIndex:
+    """In-memory prefix index over specializations, cities and doctor names.
+
+    Every word of a suggestion is stored as a lowercase key in a sorted list,
+    so a prefix lookup is a bisect plus a short scan. Suggestions are
+    reference counted per source (a doctor profile or user) so that sources
+    can be replaced or removed incrementally.
+    """
+    def __init__(self):
+        self._keys: List[tuple] = []  # Sorted (key, suggestion) pairs
+        self._refcounts: Dict[str, int] = {}
+        self._sources: Dict[str, set] = {}
+    
+    @staticmethod
+    def _index_keys(suggestion: str) -> List[tuple]:
+        words = suggestion.lower().split()
+        return [(" ".join(words[i:]), suggestion) for i in range(len(words))]
+    
+    def _add(self, suggestion: str):
+        count = self._refcounts.get(suggestion, 0)
+        self._refcounts[suggestion] = count + 1
+        if count == 0:
+            for key in self._index_keys(suggestion):
+                bisect.insort(self._keys, key)
+    
+    def _remove(self, suggestion: str):
+        count = self._refcounts.get(suggestion, 0)
+        if count <= 1:
+            self._refcounts.pop(suggestion, None)
+            for key in self._index_keys(suggestion):
+                i = bisect.bisect_left(self._keys, key)
+                if i < len(self._keys) and self._keys[i] == key:
+                    del self._keys[i]
+        else:
+            self._refcounts[suggestion] = count - 1
+    
+    def set_source(self, source_id: str, suggestions: List[str]):
+        """Replace the suggestions contributed by ``source_id``."""
+        new = {suggestion for suggestion in suggestions if suggestion and suggestion.strip()}
+        old = self._sources.get(source_id, set())
+        for suggestion in old - new:
+            self._remove(suggestion)
+        for suggestion in new - old:
+            self._add(suggestion)
+        if new:
+            self._sources[source_id] = new
+        else:
+            self._sources.pop(source_id, None)
+    
+    def remove_source(self, source_id: str):
+        self.set_source(source_id, [])
+    
+    def clear(self):
+        self._keys = []
+        self._refcounts = {}
+        self._sources = {}
+    
+    def search(self, query: str, limit: int = 10) -> List[str]:
+        prefix = query.lower().strip()
+        matches = set()
+        i = bisect.bisect_left(self._keys, (prefix,))
+        while i < len(self._keys) and self._keys[i][0].startswith(prefix):
+            matches.add(self._keys[i][1])
+            i += 1
+        return sorted(matches)[:limit]
+
+suggestion_index = SuggestionIndex()
+
+def doctor_profile_suggestions(profile: dict) -> tuple:
+    """Return the suggestion source id and suggestions of a doctor profile."""
+    suggestions = list(profile.get("specializations") or [])
+    city = (profile.get("clinic_info") or {}).get("city")
+    if city:
+        suggestions.append(city)
+    return f"profile:{profile['user_id']}", suggestions
+
+def doctor_name_suggestions(user: dict) -> tuple:
+    """Return the suggestion source id and suggestions of a doctor's name."""
+    name = user.get("name")
+    return f"user:{user['id']}", [f"Dr. {name}"] if name else []
+
+async def update_suggestion_source(source_id: str, suggestions: List[str]):
+    """Replace a source's suggestions in this worker's index and every other worker's."""
+    suggestion_index.set_source(source_id, suggestions)
+    await manager.broker.broadcast(manager.worker_id, {
+        "type": "suggestions_changed",
+        "source_id": source_id,
+        "suggestions": suggestions
+    })
+
+async def index_doctor_profile_suggestions(profile: dict):
+    await update_suggestion_source(*doctor_profile_suggestions(profile))
+
+async def index_doctor_name_suggestion(user: dict):
+    await update_suggestion_source(*doctor_name_suggestions(user))
+
+async def build_suggestion_index():
+    """Load all doctor profiles and doctor names into the suggestion index."""
+    suggestion_index.clear()
+    profiles = await db.doctor_profiles.find(
+        {}, {"_id": 0, "user_id": 1, "specializations": 1, "clinic_info.city": 1}
+    ).to_list(None)
+    for profile in profiles:
+        suggestion_index.set_source(*doctor_profile_suggestions(profile))
+    
+    users = await db.users.find(
+        {"role": UserRole.DOCTOR}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(None)
+    for user in users:
+        suggestion_index.set_source(*doctor_name_suggestions(user))
+    logger.info(f"Suggestion index built from {len(profiles)} profiles and {len(users)} doctors")
 
 # Create uploads directory
 UPLOADS_DIR = Path("uploads")
 UPLOADS_DIR.mkdir(exist_ok=True)
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
+async def save_multipart_upload(request: Request, destination: Path, field_name: str = "file",
+                                max_size: int = MAX_UPLOAD_SIZE) -> tuple:
+    """Write the ``field_name`` file part of a multipart request body to ``destination``.
+
+    The body is parsed as it arrives, so nothing is spooled first and
+    UploadTooLarge is raised as soon as the file passes ``max_size``, even
+    without a Content-Length. The SHA-256 digest is computed while writing and
+    no partial file is left behind. Returns ``(filename, size, sha256 hex digest)``.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Expected a multipart/form-data body"
+        )
+    
+    # The parser's callbacks are synchronous; they collect data that is
+    # written out after each network chunk
+    part = {"headers": {}, "header_field": b"", "header_value": b"", "is_file": False}
+    found = {"filename": None}
+    pending: List[bytes] = []
+    
+    def on_part_begin():
+        part.update(headers={}, header_field=b"", header_value=b"", is_file=False)
+    
+    def on_header_field(data, start, end):
+        part["header_field"] += data[start:end]
+    
+    def on_header_value(data, start, end):
+        part["header_value"] += data[start:end]
+    
+    def on_header_end():
+        part["headers"][part["header_field"].lower()] = part["header_value"]
+        part["header_field"] = part["header_value"] = b""
+    
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if disposition.get(b"name", b"").decode("utf-8", "replace") == field_name and found["filename"] is None:
+            part["is_file"] = True
+            found["filename"] = disposition.get(b"filename", b"").decode("utf-8", "replace")
+    
+    def on_part_data(data, start, end):
+        if part["is_file"]:
+            pending.append(data[start:end])
+    
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+    })
+    
+    digest = hashlib.sha256()
+    size = 0
+    partial_path = destination.with_name(destination.name + ".part")
+    try:
+        async with aiofiles.open(partial_path, 'wb') as f:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                for data in pending:
+                    size += len(data)
+                    if size > max_size:
+                        raise UploadTooLarge()
+                    digest.update(data)
+                    await f.write(data)
+                pending.clear()
+            parser.finalize()
+        if not found["filename"]:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No file provided"
+            )
+        partial_path.replace(destination)
+    except BaseException:
+        partial_path.unlink(missing_ok=True)
+        raise
+    return found["filename"], size, digest.hexdigest()
+
+# Content-addressed upload store
+# Uploads are stored once per distinct content under
+# uploads/blobs/<aa>/<bb>/<sha256><ext>. The file_blobs collection keeps a
+# reference count per blob, one reference per chat message pointing at it.
+BLOBS_DIR = UPLOADS_DIR / "blobs"
+BLOB_TMP_DIR = UPLOADS_DIR / "tmp"
+BLOBS_DIR.mkdir(exist_ok=True)
+BLOB_TMP_DIR.mkdir(exist_ok=True)
+BLOB_URL_PREFIX = "/uploads/blobs/"
+
+def blob_extension(filename: str) -> str:
+    extension = Path(filename).suffix.lower()
+    return extension if re.fullmatch(r"\.[a-z0-9]{1,10}", extension) else ""
+
+def blob_relative_path(blob_id: str) -> str:
+    return f"{blob_id[:2]}/{blob_id[2:4]}/{blob_id}"
+
+# Signed upload URLs
+# <img> tags can't send an Authorization header, so message responses carry a
+# short-lived HMAC signature scoped to one file (and its previews) and one user.
+def _upload_signature(file_url: str, user_id: str, expires: int) -> str:
+    mac = hmac.new(UPLOAD_URL_SECRET.encode(), f"{file_url}|{user_id}|{expires}".encode(), hashlib.sha256)
+    return base64.urlsafe_b64encode(mac.digest()).decode().rstrip("=")
+
+def sign_upload_access(file_url: str, user_id: str) -> str:
+    """Query string letting ``user_id`` fetch ``file_url`` for one to two TTLs."""
+    # Expiry is rounded so the URL, and the browser's cached copy, stays stable for a while
+    expires = (int(datetime.now().timestamp()) // UPLOAD_URL_TTL_SECONDS + 2) * UPLOAD_URL_TTL_SECONDS
+    return urlencode({"uid": user_id, "exp": expires, "sig": _upload_signature(file_url, user_id, expires)})
+
+def verify_upload_access(file_url: str, user_id: Optional[str], expires: Optional[int], signature: Optional[str]) -> bool:
+    if not (user_id and expires and signature) or expires < datetime.now().timestamp():
+        return False
+    return hmac.compare_digest(signature, _upload_signature(file_url, user_id, expires))
+
+def with_file_access(message: "ChatMessageResponse", user_id: str) -> "ChatMessageResponse":
+    if message.file_url:
+        message.file_access = sign_upload_access(message.file_url, user_id)
+    return message
+
+async def store_upload_blob(request: Request) -> dict:
+    """Stream a multipart upload into the blob store and take a reference to it.
+
+    Content that is already stored is not written again. Returns the blob
+    ``id``, ``url``, ``size``, ``sha256`` and the uploaded ``file_name``.
+    """
+    tmp_path = BLOB_TMP_DIR / str(uuid.uuid4())
+    file_name, size, digest = await save_multipart_upload(request, tmp_path)
+    blob_id = f"{digest}{blob_extension(file_name)}"
+    url = f"{BLOB_URL_PREFIX}{blob_relative_path(blob_id)}"
+    
+    previous = await db.file_blobs.find_one_and_update(
+        {"id": blob_id},
+        {
+            "$inc": {"ref_count": 1},
+            "$unset": {"released_at": "", "deleting_at": ""},
+            "$setOnInsert": {"url": url, "size": size, "sha256": digest, "created_at": datetime.utcnow()}
+        },
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    
+    # A blob being collected may lose its file at any moment, so write ours
+    blob_path = BLOBS_DIR / blob_relative_path(blob_id)
+    if blob_path.exists() and not (previous and previous.get("deleting_at")):
+        tmp_path.unlink(missing_ok=True)  # Duplicate content
+    else:
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.replace(blob_path)
+    
+    return {"id": blob_id, "url": url, "size": size, "sha256": digest, "file_name": file_name}
+
+# Image thumbnails
+# Previews are written next to the original as <file>.thumb-<label>.jpg by a
+# process pool, after the upload response has been sent.
+THUMBNAIL_SIZES = {"small": 160, "medium": 480}  # Longest edge in pixels
+THUMBNAIL_SUFFIX_PATTERN = re.compile(r"\.thumb-([a-z]+)\.jpg$")
+
+thumbnail_pool: Optional[ProcessPoolExecutor] = None  # Started with the app
+thumbnail_tasks: Set[asyncio.Task] = set()
+
+def start_thumbnail_pool():
+    """Start the thumbnail process pool.
+
+    Workers come from a forkserver rather than a fork of this process, which
+    already runs Motor's and the event loop's threads by the time it starts.
+    """
+    global thumbnail_pool
+    thumbnail_pool = ProcessPoolExecutor(
+        max_workers=THUMBNAIL_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver")
+    )
+
+def render_thumbnails(source_path: str, targets: Dict[str, tuple]) -> List[str]:
+    """Write a JPEG preview of the image for each ``label: (path, size)``.
+
+    Runs in a worker process. Returns the labels that were written.
+    """
+    written = []
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        for label, (target_path, size) in targets.items():
+            preview = image.copy()
+            preview.thumbnail((size, size))
+            partial_path = f"{target_path}.part"
+            preview.save(partial_path, "JPEG", quality=80, optimize=True)
+            os.replace(partial_path, target_path)
+            written.append(label)
+    return written
+
+async def create_message_thumbnails(message: ChatMessageResponse):
+    """Generate previews for an image message and notify both participants."""
+    source_path = UPLOADS_DIR / message.file_url[len("/uploads/"):]
+    thumbnail_urls = {label: f"{message.file_url}.thumb-{label}.jpg" for label in THUMBNAIL_SIZES}
+    targets = {
+        label: (str(source_path) + f".thumb-{label}.jpg", size)
+        for label, size in THUMBNAIL_SIZES.items()
+    }
+    
+    # Deduplicated uploads already have their previews
+    missing = {label: target for label, target in targets.items() if not Path(target[0]).exists()}
+    if missing:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(thumbnail_pool, render_thumbnails, str(source_path), missing)
+    
+    await db.chat_messages.update_one(
+        {"id": message.id},
+        {"$set": {"thumbnail_urls": thumbnail_urls}}
+    )
+    
+    notification = {
+        "type": "thumbnails_ready",
+        "conversation_id": message.conversation_id,
+        "message_id": message.id,
+        "thumbnail_urls": thumbnail_urls
+    }
+    payload = WsPayload(notification)
+    for user_id in (message.sender_id, message.receiver_id):
+        await manager.send_payload(payload, user_id)
+
+def schedule_message_thumbnails(message: ChatMessageResponse):
+    if Image is None or thumbnail_pool is None:
+        return
+    
+    async def run():
+        try:
+            await create_message_thumbnails(message)
+        except Exception as e:
+            logger.error(f"Thumbnail generation failed for message {message.id}: {e}")
+    
+    task = asyncio.create_task(run())
+    thumbnail_tasks.add(task)
+    task.add_done_callback(thumbnail_tasks.discard)
+
+async def release_upload_blob(blob_id: str):
+    """Drop one reference to a blob; unreferenced blobs are removed by collect_upload_blobs()."""
+    blob = await db.file_blobs.find_one_and_update(
+        {"id": blob_id},
+        {"$inc": {"ref_count": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob and blob["ref_count"] <= 0:
+        await db.file_blobs.update_one(
+            {"id": blob_id, "ref_count": {"$lte": 0}},
+            {"$set": {"released_at": datetime.utcnow()}}
+        )
+
+# Password hashing pool
+class PasswordHasher:
+    """Runs bcrypt hashing and verification in a bounded thread pool.
+
+    bcrypt releases the GIL, so the event loop keeps serving requests and
+    WebSockets while hashes are computed. Once ``max_pending`` operations
+    are waiting, new ones are rejected with 503 instead of queueing forever.
+    """
+    def __init__(self, max_workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+    
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+    
+    async def hash(self, password: str) -> str:
+        return await self._run(pwd_context.hash, password)
+    
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(pwd_context.verify, plain_password, hashed_password)
+    
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+    
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "queued": max(self.pending - self.max_workers, 0),
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+
+password_hasher = PasswordHasher()
+
+# Index management
+def _index_name(index: IndexModel) -> str:
+    return index.document["name"]
+
+def _index_key(index: IndexModel) -> list:
+    return list(index.document["key"].items())
+
+async def ensure_indexes() -> Dict[str, List[str]]:
+    """Create every declared index that does not exist yet.
+
+    Indexes are matched by name or key pattern, so existing indexes are left
+    alone. Returns the names of the indexes created, per collection.
+    """
+    created = {}
+    for collection_name, indexes in DATABASE_INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        existing_keys = [info["key"] for info in existing.values()]
+        for index in indexes:
+            if _index_name(index) in existing or _index_key(index) in existing_keys:
+                continue
+            try:
+                await collection.create_indexes([index])
+                created.setdefault(collection_name, []).append(_index_name(index))
+            except OperationFailure as e:
+                logger.error(f"Could not create index {_index_name(index)} on {collection_name}: {e}")
+    return created
+
+async def index_report() -> dict:
+    """Compare declared indexes with the database and report their usage.
+
+    Usage comes from ``$indexStats``, which counts the operations that used
+    each index since the server started.
+    """
+    report = {}
+    for collection_name, indexes in DATABASE_INDEXES.items():
+        collection = db[collection_name]
+        stats = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        usage = {stat["name"]: stat["accesses"]["ops"] for stat in stats}
+        declared = {_index_name(index) for index in indexes}
+        report[collection_name] = {
+            "missing": sorted(declared - usage.keys()),
+            "undeclared": sorted(name for name in usage if name not in declared and name != "_id_"),
+            "unused": sorted(name for name, ops in usage.items() if ops == 0 and name != "_id_"),
+            "usage": usage
+        }
+    return report
 
 # Utility Functions
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.verify(plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+async def get_password_hash(password: str) -> str:
+    return await password_hasher.hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -399,15 +1487,92 @@ def validate_password(password: str) -> bool:
         return False
     return True
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+class UserCache:
+    """Bounded LRU cache of verified access tokens to their ``User``.
+
+    Entries expire after ``ttl_seconds`` or when the token itself expires,
+    whichever comes first, and can be dropped per user when the user changes.
+    """
+    def __init__(self, max_size: int = USER_CACHE_MAX_SIZE, ttl_seconds: int = USER_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # token -> (expires_at, user, token_expires_at)
+        self._tokens_by_user: Dict[str, set] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, token: str) -> Optional[User]:
+        session = self.get_session(token)
+        return session[0] if session else None
+    
+    def get_session(self, token: str) -> Optional[tuple]:
+        """Return (user, token_expires_at) for a cached token."""
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, user, token_expires_at = entry
+        if datetime.utcnow() >= expires_at:
+            self._discard(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return user, token_expires_at
+    
+    def set(self, token: str, user: User, token_expires_at: Optional[datetime] = None):
+        if self.max_size <= 0:
+            return
+        expires_at = datetime.utcnow() + self.ttl
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        self._discard(token)
+        self._entries[token] = (expires_at, user, token_expires_at)
+        self._tokens_by_user.setdefault(user.id, set()).add(token)
+        while len(self._entries) > self.max_size:
+            oldest_token = next(iter(self._entries))
+            self._discard(oldest_token)
+    
+    def invalidate_user(self, user_id: str):
+        for token in list(self._tokens_by_user.get(user_id, ())):
+            self._discard(token)
+    
+    def _discard(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[1].id
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user_id]
+    
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": int(self.ttl.total_seconds()),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+user_cache = UserCache()
+
+async def authenticate_session(token: str) -> tuple:
+    """Resolve an access token to its user and the token's expiry, using the user cache."""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     
+    session = user_cache.get_session(token)
+    if session is not None:
+        return session
+    
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
@@ -418,7 +1583,18 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     if user is None:
         raise credentials_exception
     
-    return User(**user)
+    current_user = User(**user)
+    token_expires_at = datetime.utcfromtimestamp(payload["exp"]) if "exp" in payload else None
+    user_cache.set(token, current_user, token_expires_at)
+    return current_user, token_expires_at
+
+async def authenticate_token(token: str) -> User:
+    """Resolve an access token to its user, using the user cache."""
+    current_user, _ = await authenticate_session(token)
+    return current_user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await authenticate_token(credentials.credentials)
 
 def require_role(allowed_roles: List[UserRole]):
     def role_checker(current_user: User = Depends(get_current_user)):
@@ -449,7 +1625,7 @@ async def register(user_data: UserCreate):
         )
     
     # Create user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash(user_data.password)
     user_dict = user_data.dict()
     del user_dict['password']
     
@@ -459,6 +1635,8 @@ async def register(user_data: UserCreate):
     
     # Insert user into database
     await db.users.insert_one(user_doc)
+    if user.role == UserRole.DOCTOR:
+        await index_doctor_name_suggestion(user_doc)
     
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -483,7 +1661,7 @@ async def login(login_data: UserLogin):
     user = User(**user_doc)
     
     # Verify password
-    if not verify_password(login_data.password, user_doc['password']):
+    if not await verify_password(login_data.password, user_doc['password']):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
@@ -524,9 +1702,18 @@ async def update_profile(
         {"$set": update_dict}
     )
     
-    # Get updated user
-    updated_user = await db.users.find_one({"id": current_user.id})
-    return UserResponse(**User(**updated_user).dict())
+    # Keep the doctor's searchable name in sync
+    if current_user.role == UserRole.DOCTOR and 'name' in update_dict:
+        await db.doctor_profiles.update_one(
+            {"user_id": current_user.id},
+            {"$set": {"user_name": update_dict['name']}}
+        )
+        await index_doctor_name_suggestion({"id": current_user.id, "name": update_dict['name']})
+    
+    # Replace cached copies of the old user on every worker
+    updated_user = User(**await db.users.find_one({"id": current_user.id}))
+    await manager.user_changed(updated_user)
+    return UserResponse(**updated_user.dict())
 
 # Doctor Profile Routes
 @api_router.post("/doctor/profile", response_model=DoctorProfileResponse)
@@ -545,9 +1732,11 @@ async def create_doctor_profile(
     # Create doctor profile
     profile = DoctorProfile(**profile_data.dict(), user_id=current_user.id)
     profile_doc = profile.dict()
+    profile_doc['user_name'] = current_user.name  # Indexed for text search
     
     # Insert into database
     await db.doctor_profiles.insert_one(profile_doc)
+    await index_doctor_profile_suggestions(profile_doc)
     
     # Return response with user info
     response = DoctorProfileResponse(**profile.dict())
@@ -589,6 +1778,7 @@ async def update_doctor_profile(
     # Update profile
     update_dict = profile_data.dict(exclude_unset=True)
     update_dict['updated_at'] = datetime.utcnow()
+    update_dict['user_name'] = current_user.name
     
     await db.doctor_profiles.update_one(
         {"user_id": current_user.id},
@@ -597,6 +1787,7 @@ async def update_doctor_profile(
     
     # Get updated profile
     updated_profile = await db.doctor_profiles.find_one({"user_id": current_user.id})
+    await index_doctor_profile_suggestions(updated_profile)
     response = DoctorProfileResponse(**DoctorProfile(**updated_profile).dict())
     response.user_name = current_user.name
     response.user_email = current_user.email
@@ -626,37 +1817,60 @@ async def get_doctor_profile_by_id(doctor_id: str):
     
     return response
 
-@api_router.get("/doctors", response_model=List[DoctorProfileResponse])
-async def get_all_doctors(
-    # Filtering parameters
+# Doctor search
+def _user_id_hex_digit(position: int) -> dict:
+    """Aggregation expression for the hex digit at ``position`` of ``user_id``."""
+    digit = {"$indexOfCP": ["0123456789abcdef", {"$substrCP": ["$user_id", position, 1]}]}
+    return {"$max": [digit, 0]}
+
+# Mock rating 4.5-5.4 and 10-59 reviews, derived from the user id so the
+# database can filter and sort on them
+MOCK_RATING_FIELDS = {
+    "rating": {"$add": [4.5, {"$divide": [{"$mod": [_user_id_hex_digit(0), 10]}, 10]}]},
+    "total_reviews": {
+        "$add": [
+            10,
+            {"$mod": [{"$add": [{"$multiply": [_user_id_hex_digit(0), 16]}, _user_id_hex_digit(1)]}, 50]},
+        ]
+    },
+    "is_verified": True,  # Mock verification
+}
+
+DOCTOR_SORT_FIELDS = {
+    "relevance": {"search_score": -1},
+    "rating": {"rating": -1},
+    "experience": {"experience_years": -1},
+    "fee_asc": {"fee_min": 1},
+    "fee_desc": {"fee_max": -1},
+    "name": {"user.name": 1},
+}
+
+# Joins the doctor user; $unwind drops profiles whose user no longer exists
+DOCTOR_USER_JOIN = [
+    {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "id", "as": "user"}},
+    {"$unwind": "$user"},
+]
+
+def build_doctor_search_pipeline(
     specialization: Optional[str] = None,
     city: Optional[str] = None,
     consultation_type: Optional[ConsultationType] = None,
-    search: Optional[str] = None,  # New: search by name, clinic, qualifications
+    search: Optional[str] = None,
     min_fee: Optional[float] = None,
     max_fee: Optional[float] = None,
     min_experience: Optional[int] = None,
     min_rating: Optional[float] = None,
-    has_availability: Optional[bool] = None,  # New: filter by current availability
-    # Sorting parameters
-    sort_by: Optional[str] = "rating",  # rating, experience, fee_asc, fee_desc, name
-    # Pagination
-    skip: int = 0,
-    limit: int = 20
-):
-    # Build query
+    has_availability: Optional[bool] = None,
+) -> List[dict]:
+    """Build the aggregation stages that filter doctor profiles.
+
+    Joining the doctor user, sorting and pagination are left to the caller.
+    """
     query = {}
     
-    # Text search across multiple fields
+    # Full-text search across profile fields and the doctor's name
     if search:
-        search_pattern = {"$regex": search, "$options": "i"}
-        query["$or"] = [
-            {"specializations": search_pattern},
-            {"qualifications": search_pattern},
-            {"clinic_info.name": search_pattern},
-            {"bio": search_pattern}
-        ]
-        # Also search by doctor name (we'll handle this separately)
+        query["$text"] = {"$search": search}
     
     # Filter by specialization
     if specialization:
@@ -664,7 +1878,7 @@ async def get_all_doctors(
     
     # Filter by city
     if city:
-        query["clinic_info.city"] = {"$regex": city, "$options": "i"}
+        query["clinic_info.city"] = {"$regex": re.escape(city), "$options": "i"}
     
     # Filter by consultation type
     if consultation_type:
@@ -674,7 +1888,7 @@ async def get_all_doctors(
     if min_experience:
         query["experience_years"] = {"$gte": min_experience}
     
-    # Filter by fees
+    # Filter by fees (either the online or the clinic fee must be in range)
     fee_filter = {}
     if min_fee:
         fee_filter["$gte"] = min_fee
@@ -682,83 +1896,142 @@ async def get_all_doctors(
         fee_filter["$lte"] = max_fee
     
     if fee_filter:
-        # Apply fee filter to both online and clinic fees
-        query["$or"] = query.get("$or", []) + [
+        query["$or"] = [
             {"consultation_fee_online": fee_filter},
             {"consultation_fee_clinic": fee_filter}
         ]
     
-    # Get doctor profiles
-    profiles_cursor = db.doctor_profiles.find(query)
+    pipeline = [{"$match": query}]
+    
+    # Relevance of the text search match
+    if search:
+        pipeline.append({"$addFields": {"search_score": {"$meta": "textScore"}}})
+    
+    # Filter by availability within the next week
+    if has_availability:
+        today = datetime.now().date()
+        next_week = today + timedelta(days=7)
+        pipeline.append({"$lookup": {
+            "from": "availability_slots",
+            "let": {"doctor_id": "$user_id"},
+            "pipeline": [
+                {"$match": {
+                    "$expr": {"$eq": ["$doctor_id", "$$doctor_id"]},
+                    "date": {"$gte": datetime.combine(today, datetime.min.time()),
+                             "$lte": datetime.combine(next_week, datetime.max.time())},
+                    "status": AvailabilityStatus.AVAILABLE
+                }},
+                {"$limit": 1},
+                {"$project": {"_id": 1}}
+            ],
+            "as": "available_slots"
+        }})
+        pipeline.append({"$match": {"available_slots.0": {"$exists": True}}})
+        pipeline.append({"$addFields": {"has_current_availability": True}})
+    
+    # Computed fields for sorting and filtering
+    pipeline.append({"$addFields": {
+        **MOCK_RATING_FIELDS,
+        "fee_min": {"$min": [{"$ifNull": ["$consultation_fee_online", 999999]},
+                             {"$ifNull": ["$consultation_fee_clinic", 999999]}]},
+        "fee_max": {"$max": [{"$ifNull": ["$consultation_fee_online", 0]},
+                             {"$ifNull": ["$consultation_fee_clinic", 0]}]},
+    }})
+    
+    # Filter by rating
+    if min_rating:
+        pipeline.append({"$match": {"rating": {"$gte": min_rating}}})
+    
+    return pipeline
+
+async def backfill_doctor_search_names():
+    """Copy the doctor's name onto profiles created before it was denormalized."""
+    profiles = await db.doctor_profiles.find(
+        {"user_name": {"$exists": False}}, {"_id": 0, "user_id": 1}
+    ).to_list(None)
+    if not profiles:
+        return
+    
+    users = await db.users.find(
+        {"id": {"$in": [p["user_id"] for p in profiles]}}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(None)
+    for user in users:
+        await db.doctor_profiles.update_one(
+            {"user_id": user["id"]},
+            {"$set": {"user_name": user.get("name")}}
+        )
+    logger.info(f"Backfilled search names for {len(users)} doctor profiles")
+
+@api_router.get("/doctors", response_model=List[DoctorProfileResponse])
+async def get_all_doctors(
+    # Filtering parameters
+    specialization: Optional[str] = None,
+    city: Optional[str] = None,
+    consultation_type: Optional[ConsultationType] = None,
+    search: Optional[str] = None,  # New: search by name, clinic, qualifications
+    min_fee: Optional[float] = None,
+    max_fee: Optional[float] = None,
+    min_experience: Optional[int] = None,
+    min_rating: Optional[float] = None,
+    has_availability: Optional[bool] = None,  # New: filter by current availability
+    # Sorting parameters
+    sort_by: Optional[str] = None,  # relevance, rating, experience, fee_asc, fee_desc, name
+    # Pagination
+    skip: int = 0,
+    limit: int = 20
+):
+    if limit <= 0:
+        return []
+    
+    pipeline = build_doctor_search_pipeline(
+        specialization=specialization,
+        city=city,
+        consultation_type=consultation_type,
+        search=search,
+        min_fee=min_fee,
+        max_fee=max_fee,
+        min_experience=min_experience,
+        min_rating=min_rating,
+        has_availability=has_availability,
+    )
     
-    # Get all profiles first (for sorting)
-    all_profiles = await profiles_cursor.to_list(None)
+    # Rank by relevance when searching, by rating otherwise
+    if not sort_by:
+        sort_by = "relevance" if search else "rating"
+    if sort_by == "relevance" and not search:
+        sort_by = "rating"
+    
+    # Sort and paginate inside the database so only the requested page is returned
+    sort_spec = dict(DOCTOR_SORT_FIELDS.get(sort_by, {}))
+    sort_spec["user_id"] = 1  # Stable ordering across pages
+    if sort_by == "name":
+        # Only the name sort needs every match joined to its user
+        pipeline.extend(DOCTOR_USER_JOIN)
+    pipeline.append({"$sort": sort_spec})
+    pipeline.append({"$skip": max(skip, 0)})
+    pipeline.append({"$limit": limit})
+    if sort_by != "name":
+        pipeline.extend(DOCTOR_USER_JOIN)
+    # Online status for the returned page only
+    pipeline.append({"$lookup": {
+        "from": "user_presence", "localField": "user_id", "foreignField": "user_id", "as": "presence"
+    }})
+    
+    docs = await db.doctor_profiles.aggregate(pipeline).to_list(None)
     
-    # Get user information and build responses
     doctor_responses = []
-    for profile in all_profiles:
-        user = await db.users.find_one({"id": profile["user_id"]})
-        if user:
-            # Skip if name search doesn't match
-            if search and search.lower() not in user.get('name', '').lower():
-                if not any(search.lower() in str(profile.get(field, '')).lower() 
-                          for field in ['specializations', 'qualifications', 'bio']):
-                    if not (profile.get('clinic_info', {}).get('name', '') and 
-                           search.lower() in profile['clinic_info']['name'].lower()):
-                        continue
-            
-            response = DoctorProfileResponse(**DoctorProfile(**profile).dict())
-            response.user_name = user.get('name')
-            response.user_email = user.get('email')
-            
-            # Add computed fields for sorting and filtering
-            response.rating = 4.5 + (hash(profile["user_id"]) % 10) / 10  # Mock rating 4.5-5.5
-            response.total_reviews = (hash(profile["user_id"]) % 50) + 10  # Mock 10-60 reviews
-            response.is_verified = True  # Mock verification
-            response.distance = None  # Will be calculated if coordinates provided
-            
-            # Check availability for filtering
-            if has_availability:
-                today = datetime.now().date()
-                next_week = today + timedelta(days=7)
-                available_slots = await db.availability_slots.find({
-                    "doctor_id": profile["user_id"],
-                    "date": {"$gte": datetime.combine(today, datetime.min.time()), 
-                            "$lte": datetime.combine(next_week, datetime.max.time())},
-                    "status": "available"
-                }).to_list(10)
-                
-                response.has_current_availability = len(available_slots) > 0
-                if has_availability and not response.has_current_availability:
-                    continue
-            else:
-                response.has_current_availability = True  # Default assumption
-            
-            # Filter by rating
-            if min_rating and response.rating < min_rating:
-                continue
-                
-            doctor_responses.append(response)
-    
-    # Sort results
-    if sort_by == "rating":
-        doctor_responses.sort(key=lambda x: x.rating, reverse=True)
-    elif sort_by == "experience":
-        doctor_responses.sort(key=lambda x: x.experience_years or 0, reverse=True)
-    elif sort_by == "fee_asc":
-        doctor_responses.sort(key=lambda x: min(x.consultation_fee_online or 999999, 
-                                               x.consultation_fee_clinic or 999999))
-    elif sort_by == "fee_desc":
-        doctor_responses.sort(key=lambda x: max(x.consultation_fee_online or 0, 
-                                               x.consultation_fee_clinic or 0), reverse=True)
-    elif sort_by == "name":
-        doctor_responses.sort(key=lambda x: x.user_name or "")
-    
-    # Apply pagination
-    total = len(doctor_responses)
-    paginated_results = doctor_responses[skip:skip + limit]
-    
-    return paginated_results
+    for doc in docs:
+        response = DoctorProfileResponse(**DoctorProfile(**doc).dict())
+        response.user_name = doc["user"].get('name')
+        response.user_email = doc["user"].get('email')
+        response.distance = None  # Will be calculated if coordinates provided
+        response.has_current_availability = doc.get("has_current_availability", True)
+        if doc["presence"]:
+            response.is_online = doc["presence"][0].get("online", False)
+            response.last_seen = doc["presence"][0].get("last_seen")
+        doctor_responses.append(response)
+    
+    return doctor_responses
 
 @api_router.get("/doctors/filter-counts")
 async def get_doctor_filter_counts(
@@ -774,51 +2047,61 @@ async def get_doctor_filter_counts(
     if specialization:
         base_query["specializations"] = {"$in": [specialization]}
     if city:
-        base_query["clinic_info.city"] = {"$regex": city, "$options": "i"}
+        base_query["clinic_info.city"] = {"$regex": re.escape(city), "$options": "i"}
     if consultation_type:
         base_query["consultation_types"] = {"$in": [consultation_type]}
     if search:
-        search_pattern = {"$regex": search, "$options": "i"}
-        base_query["$or"] = [
-            {"specializations": search_pattern},
-            {"qualifications": search_pattern},
-            {"clinic_info.name": search_pattern},
-            {"bio": search_pattern}
-        ]
+        base_query["$text"] = {"$search": search}
+    
+    # Compute every facet in a single aggregation so only the counts leave the database
+    pipeline = [
+        {"$match": base_query},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "specializations": [
+                {"$unwind": "$specializations"},
+                {"$group": {"_id": "$specializations", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+                {"$limit": 10}
+            ],
+            "cities": [
+                {"$match": {"clinic_info.city": {"$nin": [None, ""]}}},
+                {"$group": {"_id": "$clinic_info.city", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+                {"$limit": 10}
+            ],
+            "consultation_types": [
+                {"$unwind": "$consultation_types"},
+                {"$group": {"_id": "$consultation_types", "count": {"$sum": 1}}}
+            ],
+            "experience_ranges": [
+                {"$bucket": {
+                    "groupBy": {"$ifNull": ["$experience_years", 0]},
+                    "boundaries": [float("-inf"), 6, 11, 21],
+                    "default": "20+",
+                    "output": {"count": {"$sum": 1}}
+                }}
+            ]
+        }}
+    ]
     
-    # Get all matching profiles
-    profiles = await db.doctor_profiles.find(base_query).to_list(None)
+    result = (await db.doctor_profiles.aggregate(pipeline).to_list(1))[0]
     
-    # Count specializations
-    specialization_counts = {}
-    city_counts = {}
     consultation_type_counts = {"online": 0, "clinic": 0, "both": 0}
+    for bucket in result["consultation_types"]:
+        consultation_type_counts[bucket["_id"]] = bucket["count"]
     
-    for profile in profiles:
-        # Count specializations
-        for spec in profile.get("specializations", []):
-            specialization_counts[spec] = specialization_counts.get(spec, 0) + 1
-        
-        # Count cities
-        city_name = profile.get("clinic_info", {}).get("city")
-        if city_name:
-            city_counts[city_name] = city_counts.get(city_name, 0) + 1
-        
-        # Count consultation types
-        for ctype in profile.get("consultation_types", []):
-            consultation_type_counts[ctype] = consultation_type_counts.get(ctype, 0) + 1
+    experience_labels = {float("-inf"): "0-5 years", 6: "6-10 years", 11: "11-20 years", "20+": "20+ years"}
+    experience_ranges = {label: 0 for label in experience_labels.values()}
+    for bucket in result["experience_ranges"]:
+        experience_ranges[experience_labels[bucket["_id"]]] = bucket["count"]
     
     return {
-        "total_doctors": len(profiles),
-        "specializations": dict(sorted(specialization_counts.items(), key=lambda x: x[1], reverse=True)[:10]),
-        "cities": dict(sorted(city_counts.items(), key=lambda x: x[1], reverse=True)[:10]),
+        "total_doctors": result["total"][0]["count"] if result["total"] else 0,
+        "specializations": {bucket["_id"]: bucket["count"] for bucket in result["specializations"]},
+        "cities": {bucket["_id"]: bucket["count"] for bucket in result["cities"]},
         "consultation_types": consultation_type_counts,
-        "experience_ranges": {
-            "0-5 years": len([p for p in profiles if (p.get("experience_years") or 0) <= 5]),
-            "6-10 years": len([p for p in profiles if 5 < (p.get("experience_years") or 0) <= 10]),
-            "11-20 years": len([p for p in profiles if 10 < (p.get("experience_years") or 0) <= 20]),
-            "20+ years": len([p for p in profiles if (p.get("experience_years") or 0) > 20])
-        }
+        "experience_ranges": experience_ranges
     }
 
 @api_router.get("/doctors/suggestions")
@@ -827,33 +2110,8 @@ async def get_search_suggestions(query: str):
     if len(query) < 2:
         return {"suggestions": []}
     
-    search_pattern = {"$regex": f"^{query}", "$options": "i"}
-    
-    # Get suggestions from specializations and cities
-    profiles = await db.doctor_profiles.find({}).to_list(None)
-    
-    suggestions = set()
-    
-    # Collect specializations
-    for profile in profiles:
-        for spec in profile.get("specializations", []):
-            if query.lower() in spec.lower():
-                suggestions.add(spec)
-    
-    # Collect cities
-    for profile in profiles:
-        city = profile.get("clinic_info", {}).get("city", "")
-        if query.lower() in city.lower():
-            suggestions.add(city)
-    
-    # Collect doctor names
-    users = await db.users.find({"role": "doctor"}).to_list(None)
-    for user in users:
-        name = user.get("name", "")
-        if query.lower() in name.lower():
-            suggestions.add(f"Dr. {name}")
-    
-    return {"suggestions": sorted(list(suggestions))[:10]}
+    # Served from the in-memory index, without touching the database
+    return {"suggestions": suggestion_index.search(query, limit=10)}
 
 # Availability Routes
 @api_router.post("/doctor/availability", response_model=AvailabilitySlotResponse)
@@ -998,81 +2256,137 @@ async def delete_availability_slot(
     
     return {"message": "Availability slot deleted successfully"}
 
+# Appointment enrichment
+APPOINTMENT_USER_PROJECTION = {"_id": 0, "id": 1, "name": 1, "email": 1, "phone": 1}
+APPOINTMENT_PROFILE_PROJECTION = {
+    "_id": 0,
+    "user_id": 1,
+    "specializations": 1,
+    "clinic_info": 1,
+    "consultation_fee_online": 1,
+    "consultation_fee_clinic": 1,
+}
+
+async def enrich_appointments(appointments: List[Appointment]) -> List[AppointmentResponse]:
+    """Attach doctor and patient details to appointments.
+
+    All referenced users and doctor profiles are resolved with one ``$in``
+    query per collection and joined in memory, so the number of round trips
+    does not grow with the number of appointments.
+    """
+    if not appointments:
+        return []
+    
+    user_ids = {a.doctor_id for a in appointments} | {a.patient_id for a in appointments}
+    doctor_ids = {a.doctor_id for a in appointments}
+    
+    users = await db.users.find(
+        {"id": {"$in": list(user_ids)}}, APPOINTMENT_USER_PROJECTION
+    ).to_list(None)
+    profiles = await db.doctor_profiles.find(
+        {"user_id": {"$in": list(doctor_ids)}}, APPOINTMENT_PROFILE_PROJECTION
+    ).to_list(None)
+    users_by_id = {u["id"]: u for u in users}
+    profiles_by_user_id = {p["user_id"]: p for p in profiles}
+    
+    responses = []
+    for appointment in appointments:
+        response = AppointmentResponse(**appointment.dict())
+        
+        # Doctor info
+        doctor = users_by_id.get(appointment.doctor_id)
+        doctor_profile = profiles_by_user_id.get(appointment.doctor_id)
+        if doctor:
+            response.doctor_name = doctor.get('name')
+        if doctor_profile:
+            clinic_info = doctor_profile.get('clinic_info') or {}
+            response.doctor_specializations = doctor_profile.get('specializations', [])
+            response.doctor_clinic_name = clinic_info.get('name')
+            response.doctor_clinic_address = clinic_info.get('address')
+            if appointment.consultation_type == ConsultationType.ONLINE:
+                response.consultation_fee = doctor_profile.get('consultation_fee_online')
+            elif appointment.consultation_type == ConsultationType.CLINIC:
+                response.consultation_fee = doctor_profile.get('consultation_fee_clinic')
+        
+        # Patient info
+        patient = users_by_id.get(appointment.patient_id)
+        if patient:
+            response.patient_name = patient.get('name')
+            response.patient_email = patient.get('email')
+            response.patient_phone = patient.get('phone')
+        
+        responses.append(response)
+    
+    return responses
+
 # Appointment Routes
 @api_router.post("/appointments", response_model=AppointmentResponse)
 async def book_appointment(
     appointment_data: AppointmentCreate,
     current_user: User = Depends(require_role([UserRole.PATIENT]))
 ):
-    # Check if availability slot exists and is available
-    slot = await db.availability_slots.find_one({
-        "id": appointment_data.availability_slot_id,
-        "doctor_id": appointment_data.doctor_id,
-        "status": AvailabilityStatus.AVAILABLE
-    })
-    
-    if not slot:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Availability slot not found or already booked"
-        )
+    # Atomically claim the slot; concurrent bookings of the same slot are
+    # resolved by the database and only one of them matches
+    slot_day = datetime.combine(appointment_data.appointment_date.date(), datetime.min.time())
+    claimed_slot = await db.availability_slots.find_one_and_update(
+        {
+            "id": appointment_data.availability_slot_id,
+            "doctor_id": appointment_data.doctor_id,
+            "status": AvailabilityStatus.AVAILABLE,
+            "date": {"$gte": slot_day, "$lt": slot_day + timedelta(days=1)},
+            "start_time": appointment_data.start_time,
+            "end_time": appointment_data.end_time
+        },
+        {"$set": {"status": AvailabilityStatus.BOOKED}},
+        projection={"_id": 1}
+    )
     
-    # Validate appointment date and time match the slot
-    slot_obj = AvailabilitySlot(**slot)
-    if (appointment_data.appointment_date.date() != slot_obj.date.date() or
-        appointment_data.start_time != slot_obj.start_time or
-        appointment_data.end_time != slot_obj.end_time):
+    if not claimed_slot:
+        # Work out why the claim failed
+        slot = await db.availability_slots.find_one({
+            "id": appointment_data.availability_slot_id,
+            "doctor_id": appointment_data.doctor_id,
+            "status": AvailabilityStatus.AVAILABLE
+        }, {"_id": 1})
+        if not slot:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Availability slot not found or already booked"
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Appointment details don't match the availability slot"
         )
     
-    # Check if patient already has an appointment at this time
-    existing_appointment = await db.appointments.find_one({
-        "patient_id": current_user.id,
-        "appointment_date": appointment_data.appointment_date,
-        "start_time": appointment_data.start_time,
-        "status": {"$in": [AppointmentStatus.PENDING, AppointmentStatus.CONFIRMED]}
-    })
-    
-    if existing_appointment:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="You already have an appointment scheduled at this time"
+    try:
+        # Check if patient already has an appointment at this time
+        existing_appointment = await db.appointments.find_one({
+            "patient_id": current_user.id,
+            "appointment_date": appointment_data.appointment_date,
+            "start_time": appointment_data.start_time,
+            "status": {"$in": [AppointmentStatus.PENDING, AppointmentStatus.CONFIRMED]}
+        }, {"_id": 1})
+        
+        if existing_appointment:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="You already have an appointment scheduled at this time"
+            )
+        
+        # Create appointment
+        appointment = Appointment(**appointment_data.dict(), patient_id=current_user.id)
+        await db.appointments.insert_one(appointment.dict())
+    except Exception:
+        # Release the slot so it can be booked again
+        await db.availability_slots.update_one(
+            {"id": appointment_data.availability_slot_id},
+            {"$set": {"status": AvailabilityStatus.AVAILABLE}}
         )
-    
-    # Create appointment
-    appointment = Appointment(**appointment_data.dict(), patient_id=current_user.id)
-    appointment_doc = appointment.dict()
-    
-    # Insert appointment and update availability slot status
-    await db.appointments.insert_one(appointment_doc)
-    await db.availability_slots.update_one(
-        {"id": appointment_data.availability_slot_id},
-        {"$set": {"status": AvailabilityStatus.BOOKED}}
-    )
+        raise
     
     # Get doctor and patient info for response
-    doctor = await db.users.find_one({"id": appointment_data.doctor_id})
-    doctor_profile = await db.doctor_profiles.find_one({"user_id": appointment_data.doctor_id})
-    
-    response = AppointmentResponse(**appointment.dict())
-    if doctor:
-        response.doctor_name = doctor.get('name')
-    if doctor_profile:
-        response.doctor_specializations = doctor_profile.get('specializations', [])
-        response.doctor_clinic_name = doctor_profile.get('clinic_info', {}).get('name')
-        response.doctor_clinic_address = doctor_profile.get('clinic_info', {}).get('address')
-        if appointment_data.consultation_type == ConsultationType.ONLINE:
-            response.consultation_fee = doctor_profile.get('consultation_fee_online')
-        elif appointment_data.consultation_type == ConsultationType.CLINIC:
-            response.consultation_fee = doctor_profile.get('consultation_fee_clinic')
-    
-    response.patient_name = current_user.name
-    response.patient_email = current_user.email
-    response.patient_phone = current_user.phone
-    
-    return response
+    responses = await enrich_appointments([appointment])
+    return responses[0]
 
 @api_router.get("/appointments", response_model=List[AppointmentResponse])
 async def get_my_appointments(
@@ -1123,35 +2437,7 @@ async def get_my_appointments(
     appointments = await db.appointments.find(query).sort("appointment_date", 1).to_list(100)
     
     # Enrich with doctor and patient information
-    appointment_responses = []
-    for appt in appointments:
-        appointment = Appointment(**appt)
-        response = AppointmentResponse(**appointment.dict())
-        
-        # Get doctor info
-        doctor = await db.users.find_one({"id": appointment.doctor_id})
-        doctor_profile = await db.doctor_profiles.find_one({"user_id": appointment.doctor_id})
-        if doctor:
-            response.doctor_name = doctor.get('name')
-        if doctor_profile:
-            response.doctor_specializations = doctor_profile.get('specializations', [])
-            response.doctor_clinic_name = doctor_profile.get('clinic_info', {}).get('name')
-            response.doctor_clinic_address = doctor_profile.get('clinic_info', {}).get('address')
-            if appointment.consultation_type == ConsultationType.ONLINE:
-                response.consultation_fee = doctor_profile.get('consultation_fee_online')
-            elif appointment.consultation_type == ConsultationType.CLINIC:
-                response.consultation_fee = doctor_profile.get('consultation_fee_clinic')
-        
-        # Get patient info
-        patient = await db.users.find_one({"id": appointment.patient_id})
-        if patient:
-            response.patient_name = patient.get('name')
-            response.patient_email = patient.get('email')
-            response.patient_phone = patient.get('phone')
-        
-        appointment_responses.append(response)
-    
-    return appointment_responses
+    return await enrich_appointments([Appointment(**appt) for appt in appointments])
 
 @api_router.get("/appointments/{appointment_id}", response_model=AppointmentResponse)
 async def get_appointment_details(
@@ -1177,30 +2463,8 @@ async def get_appointment_details(
         )
     
     # Build response with complete information
-    response = AppointmentResponse(**appointment_obj.dict())
-    
-    # Get doctor info
-    doctor = await db.users.find_one({"id": appointment_obj.doctor_id})
-    doctor_profile = await db.doctor_profiles.find_one({"user_id": appointment_obj.doctor_id})
-    if doctor:
-        response.doctor_name = doctor.get('name')
-    if doctor_profile:
-        response.doctor_specializations = doctor_profile.get('specializations', [])
-        response.doctor_clinic_name = doctor_profile.get('clinic_info', {}).get('name')
-        response.doctor_clinic_address = doctor_profile.get('clinic_info', {}).get('address')
-        if appointment_obj.consultation_type == ConsultationType.ONLINE:
-            response.consultation_fee = doctor_profile.get('consultation_fee_online')
-        elif appointment_obj.consultation_type == ConsultationType.CLINIC:
-            response.consultation_fee = doctor_profile.get('consultation_fee_clinic')
-    
-    # Get patient info
-    patient = await db.users.find_one({"id": appointment_obj.patient_id})
-    if patient:
-        response.patient_name = patient.get('name')
-        response.patient_email = patient.get('email')
-        response.patient_phone = patient.get('phone')
-    
-    return response
+    responses = await enrich_appointments([appointment_obj])
+    return responses[0]
 
 @api_router.put("/appointments/{appointment_id}", response_model=AppointmentResponse)
 async def update_appointment_status(
@@ -1391,6 +2655,23 @@ async def get_admin_dashboard(
         }
     }
 
+@api_router.get("/admin/indexes")
+async def get_admin_index_report(
+    current_user: User = Depends(require_role([UserRole.ADMIN]))
+):
+    return await index_report()
+
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(
+    current_user: User = Depends(require_role([UserRole.ADMIN]))
+):
+    return {
+        "user_cache": user_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "read_receipts": read_receipt_writer.stats(),
+        "chat_connections": manager.stats()
+    }
+
 # Test Routes
 @api_router.get("/")
 async def root():
@@ -1421,27 +2702,10 @@ async def get_user_by_id(
         )
     return UserResponse(**User(**user).dict())
 
-# Chat System Routes
-@app.websocket("/ws/chat/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
-    try:
-        while True:
-            data = await websocket.receive_text()
-            # Keep connection alive - actual message sending happens through REST API
-            await websocket.send_text(json.dumps({"type": "ping", "message": "Connection alive"}))
-    except WebSocketDisconnect:
-        manager.disconnect(user_id)
-
-@api_router.post("/chat/send", response_model=ChatMessageResponse)
-async def send_message(
-    request: SendMessageRequest,
-    current_user: User = Depends(get_current_user)
-):
-    """Send a text message"""
-    # Find or create conversation
+# Chat helpers
+async def find_or_create_conversation(user_id: str, other_user_id: str, appointment_id: Optional[str] = None) -> dict:
     conversation_query = {
-        "participants": {"$all": [current_user.id, request.receiver_id]},
+        "participants": {"$all": [user_id, other_user_id]},
         "is_active": True
     }
     
@@ -1450,140 +2714,462 @@ async def send_message(
     if not conversation:
         # Create new conversation
         conversation_data = ChatConversation(
-            participants=[current_user.id, request.receiver_id],
-            appointment_id=request.appointment_id
+            participants=[user_id, other_user_id],
+            appointment_id=appointment_id
         )
         await db.chat_conversations.insert_one(conversation_data.dict())
         conversation = conversation_data.dict()
     
+    return conversation
+
+async def create_chat_message(
+    sender: User,
+    receiver_id: str,
+    message_type: MessageType,
+    content: str,
+    appointment_id: Optional[str] = None,
+    file_url: Optional[str] = None,
+    file_name: Optional[str] = None,
+    file_size: Optional[int] = None,
+    file_hash: Optional[str] = None
+) -> ChatMessageResponse:
+    """Persist a message, update its conversation and notify the receiver."""
+    conversation = await find_or_create_conversation(sender.id, receiver_id, appointment_id)
+    
     # Create message
     message_data = ChatMessage(
         conversation_id=conversation["id"],
-        sender_id=current_user.id,
-        receiver_id=request.receiver_id,
-        message_type=request.message_type,
-        content=request.content
+        sender_id=sender.id,
+        receiver_id=receiver_id,
+        message_type=message_type,
+        content=content,
+        file_url=file_url,
+        file_name=file_name,
+        file_size=file_size,
+        file_hash=file_hash
     )
     
     # Save message to database
     await db.chat_messages.insert_one(message_data.dict())
     
-    # Update conversation's last message
+    # Update conversation's last message and the receiver's unread counter
     await db.chat_conversations.update_one(
         {"id": conversation["id"]},
         {
             "$set": {
                 "last_message_id": message_data.id,
                 "last_message_at": message_data.created_at
-            }
+            },
+            "$inc": {f"unread_counts.{receiver_id}": 1}
         }
     )
     
     # Build response
     response = ChatMessageResponse(**message_data.dict())
-    response.sender_name = current_user.name
-    response.sender_role = current_user.role
+    response.sender_name = sender.name
+    response.sender_role = sender.role
     
-    # Send real-time notification to receiver
+    # Send real-time notification to receiver, with file access signed for them
     notification = {
         "type": "new_message",
-        "message": response.dict()
+        "message": with_file_access(response.copy(), receiver_id).dict()
     }
-    await manager.send_personal_message(notification, request.receiver_id)
+    with_file_access(response, sender.id)
+    await manager.send_personal_message(notification, receiver_id)
     
     return response
 
+async def mark_conversation_read(conversation: dict, reader_id: str, up_to: Optional[datetime] = None) -> int:
+    """Mark messages sent to ``reader_id`` in the conversation as read.
+
+    Only messages created at or before ``up_to`` are marked when it is given.
+    The other participant receives a ``read`` event. Returns the number of
+    messages that changed.
+    """
+    read_at = datetime.utcnow()
+    message_filter = {
+        "conversation_id": conversation["id"],
+        "receiver_id": reader_id,
+        "status": {"$ne": MessageStatus.READ}
+    }
+    if up_to is not None:
+        message_filter["created_at"] = {"$lte": up_to}
+    result = await db.chat_messages.update_many(
+        message_filter,
+        {
+            "$set": {
+                "status": MessageStatus.READ,
+                "read_at": read_at
+            }
+        }
+    )
+    if result.modified_count:
+        await db.chat_conversations.update_one(
+            {"id": conversation["id"]},
+            {"$inc": {f"unread_counts.{reader_id}": -result.modified_count}}
+        )
+        for participant_id in conversation["participants"]:
+            if participant_id != reader_id:
+                await manager.send_personal_message({
+                    "type": "read",
+                    "conversation_id": conversation["id"],
+                    "reader_id": reader_id,
+                    "read_at": read_at
+                }, participant_id)
+    return result.modified_count
+
+class ReadReceiptWriter:
+    """Marks conversations read in the background.
+
+    Requests are coalesced per (conversation, reader) and written when the
+    flush interval elapses or ``batch_size`` conversations are waiting.
+    Senders get their ``read`` events once the write is done.
+    """
+    def __init__(self, flush_interval: float = READ_RECEIPT_FLUSH_INTERVAL_SECONDS,
+                 batch_size: int = READ_RECEIPT_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending: Dict[tuple, tuple] = {}  # (conversation id, reader id) -> (conversation, up_to)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.requested = 0
+        self.flushed = 0
+    
+    def enqueue(self, conversation: dict, reader_id: str, up_to: datetime):
+        key = (conversation["id"], reader_id)
+        if key in self._pending:
+            up_to = max(up_to, self._pending[key][1])
+        self._pending[key] = (conversation, up_to)
+        self.requested += 1
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+    
+    async def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        # Let a flush in progress finish rather than cancelling it mid-batch
+        self._stopping = True
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for (conversation_id, reader_id), (conversation, up_to) in pending.items():
+            try:
+                await mark_conversation_read(conversation, reader_id, up_to)
+                self.flushed += 1
+            except Exception as e:
+                logger.error(f"Failed to mark conversation {conversation_id} read for {reader_id}: {e}")
+    
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "requested": self.requested,
+            "flushed": self.flushed
+        }
+
+read_receipt_writer = ReadReceiptWriter()
+
+async def mark_message_as_read(message_id: str, reader_id: str) -> Optional[dict]:
+    """Mark one message as read and notify its sender.
+
+    Returns the message as it was before the update, or None if the reader
+    did not receive such a message.
+    """
+    read_at = datetime.utcnow()
+    previous = await db.chat_messages.find_one_and_update(
+        {
+            "id": message_id,
+            "receiver_id": reader_id
+        },
+        {
+            "$set": {
+                "status": MessageStatus.READ,
+                "read_at": read_at
+            }
+        },
+        projection={"_id": 0, "conversation_id": 1, "sender_id": 1, "status": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    
+    if previous is not None and previous["status"] != MessageStatus.READ:
+        await db.chat_conversations.update_one(
+            {"id": previous["conversation_id"]},
+            {"$inc": {f"unread_counts.{reader_id}": -1}}
+        )
+        await manager.send_personal_message({
+            "type": "read",
+            "conversation_id": previous["conversation_id"],
+            "message_id": message_id,
+            "reader_id": reader_id,
+            "read_at": read_at
+        }, previous["sender_id"])
+    
+    return previous
+
+# WebSocket chat protocol
+# Clients send JSON frames with a "type" and an optional "client_id", which is
+# echoed back in the "ack" or "error" reply:
+#   {"type": "send", "receiver_id", "content", "message_type"?, "appointment_id"?}
+#   {"type": "read", "message_id"} or {"type": "read", "conversation_id"}
+#   {"type": "typing", "conversation_id", "is_typing"?}
+# Any other frame is answered with a keep-alive ping.
+CHAT_FRAME_TYPES = {"send", "read", "typing"}
+
+async def handle_chat_frame(user: User, frame: dict) -> Optional[dict]:
+    """Handle one chat frame and return the reply for the sending socket."""
+    client_id = frame.get("client_id")
+    
+    try:
+        if frame["type"] == "send":
+            request = SendMessageRequest(**frame)
+            response = await create_chat_message(
+                user, request.receiver_id, request.message_type, request.content, request.appointment_id
+            )
+            return {"type": "ack", "client_id": client_id, "message": response.dict()}
+        
+        if frame["type"] == "read":
+            if frame.get("message_id"):
+                if await mark_message_as_read(frame["message_id"], user.id) is None:
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found")
+            else:
+                conversation = await db.chat_conversations.find_one({
+                    "id": frame["conversation_id"],
+                    "participants": user.id
+                })
+                if not conversation:
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+                await mark_conversation_read(conversation, user.id)
+            return {"type": "ack", "client_id": client_id}
+        
+        if frame["type"] == "typing":
+            # Only the user's own conversation partners are notified
+            conversation = await db.chat_conversations.find_one(
+                {"id": frame["conversation_id"], "participants": user.id},
+                {"_id": 0, "participants": 1}
+            )
+            if not conversation:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+            payload = WsPayload({
+                "type": "typing",
+                "sender_id": user.id,
+                "conversation_id": frame["conversation_id"],
+                "is_typing": bool(frame.get("is_typing", True))
+            })
+            for participant_id in conversation["participants"]:
+                if participant_id != user.id:
+                    await manager.send_payload(payload, participant_id)
+            return None
+    except KeyError as e:
+        return {"type": "error", "client_id": client_id, "detail": f"Missing field {e}"}
+    except ValidationError as e:
+        return {"type": "error", "client_id": client_id, "detail": str(e)}
+    except HTTPException as e:
+        return {"type": "error", "client_id": client_id, "detail": e.detail}
+    except Exception as e:
+        # Keep the socket open when a frame fails, e.g. on a database error
+        logger.error(f"Chat frame {frame['type']} from {user.id} failed: {e}")
+        return {"type": "error", "client_id": client_id, "detail": "Internal error"}
+
+# Chat System Routes
+def _ws_ticket_signature(user_id: str, expires: int, session_expires: int) -> str:
+    mac = hmac.new(JWT_SECRET.encode(), f"ws-ticket|{user_id}|{expires}|{session_expires}".encode(), hashlib.sha256)
+    return base64.urlsafe_b64encode(mac.digest()).decode().rstrip("=")
+
+def sign_ws_ticket(user_id: str, session_expires_at: Optional[datetime]) -> str:
+    """Ticket letting ``user_id`` open a chat socket within the next few seconds.
+
+    Carries the access token's expiry so the socket still closes when the
+    session ends.
+    """
+    expires = int(datetime.now().timestamp()) + WS_TICKET_TTL_SECONDS
+    session_expires = int(session_expires_at.replace(tzinfo=timezone.utc).timestamp()) if session_expires_at else 0
+    return f"{user_id}.{expires}.{session_expires}.{_ws_ticket_signature(user_id, expires, session_expires)}"
+
+async def authenticate_ws_ticket(ticket: str) -> tuple:
+    """Resolve a chat socket ticket to its user and session expiry."""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials"
+    )
+    try:
+        user_id, expires, session_expires, signature = ticket.split(".")
+        expires, session_expires = int(expires), int(session_expires)
+    except ValueError:
+        raise credentials_exception
+    if expires < datetime.now().timestamp() or not hmac.compare_digest(
+        signature, _ws_ticket_signature(user_id, expires, session_expires)
+    ):
+        raise credentials_exception
+    
+    user = await db.users.find_one({"id": user_id})
+    if user is None:
+        raise credentials_exception
+    return User(**user), datetime.utcfromtimestamp(session_expires) if session_expires else None
+
+@api_router.post("/chat/ws-ticket")
+async def create_ws_ticket(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Issue a short-lived ticket for opening the chat WebSocket.
+
+    Browsers can't set headers on the handshake, so they put this ticket in
+    the socket URL rather than their long-lived access token.
+    """
+    current_user, token_expires_at = await authenticate_session(credentials.credentials)
+    return {"ticket": sign_ws_ticket(current_user.id, token_expires_at), "expires_in": WS_TICKET_TTL_SECONDS}
+
+def websocket_token(websocket: WebSocket) -> Optional[str]:
+    """Take the access token from a bearer header, for clients that can set one."""
+    authorization = websocket.headers.get("authorization", "")
+    scheme, _, credentials = authorization.partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        return credentials
+    return None
+
+PING_PAYLOAD = WsPayload({"type": "ping", "message": "Connection alive"})
+
+def negotiate_subprotocol(websocket: WebSocket) -> Optional[str]:
+    """Pick the first wire format the client offers that this server supports."""
+    for offered in websocket.scope.get("subprotocols", []):
+        if offered in WS_SUBPROTOCOLS:
+            return offered
+    return None
+
+def decode_ws_frame(connection: ChatConnection, message: dict) -> Any:
+    """Decode an incoming frame in the connection's wire format; None if malformed."""
+    data = message.get("text") if message.get("text") is not None else message.get("bytes")
+    try:
+        if connection.wire_format == "msgpack" and isinstance(data, bytes):
+            return msgpack.unpackb(data)
+        return decode_ws_message(data)
+    except Exception:
+        return None
+
+@app.websocket("/ws/chat/{user_id}")
+async def websocket_endpoint(websocket: WebSocket, user_id: str, ticket: Optional[str] = None, binary: bool = False):
+    # Authenticate once at the handshake, with a ticket from /api/chat/ws-ticket
+    # or a bearer header; frames reuse the connection's user.
+    # Clients passing ?binary=1 get events as binary frames of UTF-8 JSON, and
+    # clients offering the chat.msgpack subprotocol get MessagePack frames.
+    # permessage-deflate is negotiated by the server (uvicorn --ws-per-message-deflate).
+    token = websocket_token(websocket)
+    user = None
+    try:
+        if ticket:
+            user, expires_at = await authenticate_ws_ticket(ticket)
+        elif token:
+            user, expires_at = await authenticate_session(token)
+    except HTTPException:
+        user = None
+    if user is None or user.id != user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    subprotocol = negotiate_subprotocol(websocket)
+    connection = ChatConnection(websocket, user, expires_at, binary, WS_SUBPROTOCOLS.get(subprotocol, "json"))
+    try:
+        await manager.connect(connection, subprotocol)
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+            connection.heartbeat()
+            if connection.is_expired():
+                await manager.disconnect(connection)
+                error = WsPayload({"type": "error", "detail": "Access token expired"}).encode(connection.wire_format)
+                if connection.binary:
+                    await websocket.send_bytes(error)
+                else:
+                    await websocket.send_text(error.decode())
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                break
+            
+            frame = decode_ws_frame(connection, message)
+            if not isinstance(frame, dict) or frame.get("type") not in CHAT_FRAME_TYPES:
+                # Keep connection alive
+                await manager.send(connection, PING_PAYLOAD)
+                continue
+            
+            reply = await handle_chat_frame(connection.user, frame)
+            if reply is not None:
+                await manager.send(connection, WsPayload(reply))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await manager.disconnect(connection)
+
+@api_router.post("/chat/send", response_model=ChatMessageResponse)
+async def send_message(
+    request: SendMessageRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """Send a text message"""
+    return await create_chat_message(
+        current_user,
+        request.receiver_id,
+        request.message_type,
+        request.content,
+        request.appointment_id
+    )
+
 @api_router.post("/chat/upload", response_model=ChatMessageResponse)
 async def upload_file_message(
+    request: Request,
     receiver_id: str,
     appointment_id: Optional[str] = None,
-    file: UploadFile = File(...),
     current_user: User = Depends(get_current_user)
 ):
-    """Upload and send a file message"""
-    # Validate file
-    if not file.filename:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="No file provided"
-        )
-    
-    # Check file size (10MB limit)
-    MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-    file_content = await file.read()
-    if len(file_content) > MAX_FILE_SIZE:
+    """Upload and send a file message.
+
+    The body is multipart/form-data with the file in a ``file`` field.
+    """
+    # Stream the file into the blob store, enforcing the 10MB limit as it arrives
+    try:
+        blob = await store_upload_blob(request)
+    except UploadTooLarge:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="File size too large (max 10MB)"
         )
+    file_name = blob["file_name"]
     
     # Determine file type
-    mime_type, _ = mimetypes.guess_type(file.filename)
+    mime_type, _ = mimetypes.guess_type(file_name)
     message_type = MessageType.IMAGE if mime_type and mime_type.startswith('image/') else MessageType.FILE
     
-    # Save file
-    file_id = str(uuid.uuid4())
-    file_extension = Path(file.filename).suffix
-    safe_filename = f"{file_id}{file_extension}"
-    file_path = UPLOADS_DIR / safe_filename
-    
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(file_content)
-    
-    # Find or create conversation
-    conversation_query = {
-        "participants": {"$all": [current_user.id, receiver_id]},
-        "is_active": True
-    }
-    
-    conversation = await db.chat_conversations.find_one(conversation_query)
-    
-    if not conversation:
-        # Create new conversation
-        conversation_data = ChatConversation(
-            participants=[current_user.id, receiver_id],
-            appointment_id=appointment_id
+    try:
+        response = await create_chat_message(
+            current_user,
+            receiver_id,
+            message_type,
+            f"Sent a {message_type.value}: {file_name}",
+            appointment_id,
+            file_url=blob["url"],
+            file_name=file_name,
+            file_size=blob["size"],
+            file_hash=blob["sha256"]
         )
-        await db.chat_conversations.insert_one(conversation_data.dict())
-        conversation = conversation_data.dict()
-    
-    # Create message
-    message_data = ChatMessage(
-        conversation_id=conversation["id"],
-        sender_id=current_user.id,
-        receiver_id=receiver_id,
-        message_type=message_type,
-        content=f"Sent a {message_type.value}: {file.filename}",
-        file_url=f"/uploads/{safe_filename}",
-        file_name=file.filename,
-        file_size=len(file_content)
-    )
+    except Exception:
+        await release_upload_blob(blob["id"])
+        raise
     
-    # Save message to database
-    await db.chat_messages.insert_one(message_data.dict())
-    
-    # Update conversation's last message
-    await db.chat_conversations.update_one(
-        {"id": conversation["id"]},
-        {
-            "$set": {
-                "last_message_id": message_data.id,
-                "last_message_at": message_data.created_at
-            }
-        }
-    )
-    
-    # Build response
-    response = ChatMessageResponse(**message_data.dict())
-    response.sender_name = current_user.name
-    response.sender_role = current_user.role
-    
-    # Send real-time notification to receiver
-    notification = {
-        "type": "new_message",
-        "message": response.dict()
-    }
-    await manager.send_personal_message(notification, receiver_id)
+    # Previews are generated in the background
+    if message_type == MessageType.IMAGE:
+        schedule_message_thumbnails(response)
     
     return response
 
@@ -1592,58 +3178,113 @@ async def get_conversations(
     current_user: User = Depends(get_current_user)
 ):
     """Get all conversations for the current user"""
-    conversations = await db.chat_conversations.find(
-        {
-            "participants": current_user.id,
-            "is_active": True
-        }
-    ).sort("last_message_at", -1).to_list(100)
+    # Participant info and last message are joined in one aggregation
+    pipeline = [
+        {"$match": {"participants": current_user.id, "is_active": True}},
+        {"$sort": {"last_message_at": -1}},
+        {"$limit": 100},
+        # Equality lookups so the joins use the users.id and user_presence.user_id indexes
+        {"$lookup": {
+            "from": "users",
+            "localField": "participants",
+            "foreignField": "id",
+            "as": "other_users"
+        }},
+        {"$lookup": {
+            "from": "user_presence",
+            "localField": "participants",
+            "foreignField": "user_id",
+            "as": "other_presence"
+        }},
+        {"$lookup": {
+            "from": "chat_messages",
+            "localField": "last_message_id",
+            "foreignField": "id",
+            "as": "last_messages"
+        }},
+        {"$addFields": {
+            "other_users": {"$map": {
+                "input": {"$filter": {"input": "$other_users", "cond": {"$ne": ["$$this.id", current_user.id]}}},
+                "in": {"id": "$$this.id", "name": "$$this.name", "role": "$$this.role"}
+            }},
+            "other_presence": {"$map": {
+                "input": {"$filter": {"input": "$other_presence", "cond": {"$ne": ["$$this.user_id", current_user.id]}}},
+                "in": {"online": "$$this.online", "last_seen": "$$this.last_seen"}
+            }},
+        }},
+        {"$project": {"_id": 0}}
+    ]
+    conversations = await db.chat_conversations.aggregate(pipeline).to_list(None)
     
     conversation_responses = []
     for conv in conversations:
         conversation = ChatConversation(**conv)
         response = ChatConversationResponse(**conversation.dict())
         
-        # Get other participant info
-        other_participant_id = next((p for p in conversation.participants if p != current_user.id), None)
-        if other_participant_id:
-            other_user = await db.users.find_one({"id": other_participant_id})
-            if other_user:
-                response.other_participant_name = other_user.get("name")
-                response.other_participant_role = other_user.get("role")
+        # Other participant info
+        other_user = conv["other_users"][0] if conv["other_users"] else None
+        if other_user:
+            response.other_participant_name = other_user.get("name")
+            response.other_participant_role = other_user.get("role")
+        if conv["other_presence"]:
+            response.other_participant_online = conv["other_presence"][0].get("online", False)
+            response.other_participant_last_seen = conv["other_presence"][0].get("last_seen")
         
-        # Get last message
-        if conversation.last_message_id:
-            last_message = await db.chat_messages.find_one({"id": conversation.last_message_id})
-            if last_message:
-                msg_response = ChatMessageResponse(**last_message)
-                # Get sender info
-                sender = await db.users.find_one({"id": last_message["sender_id"]})
-                if sender:
-                    msg_response.sender_name = sender.get("name")
-                    msg_response.sender_role = sender.get("role")
-                response.last_message = msg_response
+        # Last message; its sender is one of the two participants
+        if conv["last_messages"]:
+            last_message = conv["last_messages"][0]
+            msg_response = with_file_access(ChatMessageResponse(**last_message), current_user.id)
+            if last_message["sender_id"] == current_user.id:
+                msg_response.sender_name = current_user.name
+                msg_response.sender_role = current_user.role
+            elif other_user and last_message["sender_id"] == other_user["id"]:
+                msg_response.sender_name = other_user.get("name")
+                msg_response.sender_role = other_user.get("role")
+            response.last_message = msg_response
         
-        # Count unread messages
-        unread_count = await db.chat_messages.count_documents({
-            "conversation_id": conversation.id,
-            "receiver_id": current_user.id,
-            "status": {"$ne": MessageStatus.READ}
-        })
-        response.unread_count = unread_count
+        response.unread_count = max(conversation.unread_counts.get(current_user.id, 0), 0)
         
         conversation_responses.append(response)
     
     return conversation_responses
 
+def encode_message_cursor(message: dict) -> str:
+    raw = f"{message['created_at'].isoformat()}|{message['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_message_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), message_id
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
 @api_router.get("/chat/messages/{conversation_id}", response_model=List[ChatMessageResponse])
 async def get_messages(
     conversation_id: str,
+    response: Response,
     limit: int = 50,
     offset: int = 0,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
-    """Get messages for a conversation"""
+    """Get messages for a conversation.
+
+    ``before``/``after`` take the cursors returned in the X-Before-Cursor and
+    X-After-Cursor headers and page by (created_at, id); ``offset`` is kept
+    for older clients.
+    """
+    if before and after:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before or after, not both"
+        )
+    
     # Verify user is part of conversation
     conversation = await db.chat_conversations.find_one({
         "id": conversation_id,
@@ -1656,38 +3297,49 @@ async def get_messages(
             detail="Conversation not found"
         )
     
-    # Get messages
-    messages = await db.chat_messages.find(
-        {"conversation_id": conversation_id}
-    ).sort("created_at", -1).skip(offset).limit(limit).to_list(limit)
+    # Get messages, seeking past the cursor when one is given
+    query = {"conversation_id": conversation_id}
+    if before or after:
+        created_at, message_id = decode_message_cursor(before or after)
+        op = "$lt" if before else "$gt"
+        query["$or"] = [
+            {"created_at": {op: created_at}},
+            {"created_at": created_at, "id": {op: message_id}}
+        ]
+    direction = 1 if after else -1
+    cursor = db.chat_messages.find(query).sort([("created_at", direction), ("id", direction)])
+    if not (before or after):
+        cursor = cursor.skip(offset)
+    messages = await cursor.limit(limit).to_list(limit)
+    if direction == -1:
+        messages.reverse()  # Chronological order
+    
+    if messages:
+        response.headers["X-Before-Cursor"] = encode_message_cursor(messages[0])
+        response.headers["X-After-Cursor"] = encode_message_cursor(messages[-1])
+    
+    # Resolve senders once per page; they can only be the participants
+    senders = {current_user.id: {"name": current_user.name, "role": current_user.role}}
+    other_ids = list({msg["sender_id"] for msg in messages} - senders.keys())
+    if other_ids:
+        other_users = await db.users.find(
+            {"id": {"$in": other_ids}}, {"_id": 0, "id": 1, "name": 1, "role": 1}
+        ).to_list(None)
+        senders.update({user["id"]: user for user in other_users})
     
     # Build responses with sender info
     message_responses = []
-    for msg in reversed(messages):  # Reverse to get chronological order
-        response = ChatMessageResponse(**msg)
-        
-        # Get sender info
-        sender = await db.users.find_one({"id": msg["sender_id"]})
+    for msg in messages:
+        message_response = with_file_access(ChatMessageResponse(**msg), current_user.id)
+        sender = senders.get(msg["sender_id"])
         if sender:
-            response.sender_name = sender.get("name")
-            response.sender_role = sender.get("role")
-        
-        message_responses.append(response)
+            message_response.sender_name = sender.get("name")
+            message_response.sender_role = sender.get("role")
+        message_responses.append(message_response)
     
-    # Mark messages as read
-    await db.chat_messages.update_many(
-        {
-            "conversation_id": conversation_id,
-            "receiver_id": current_user.id,
-            "status": {"$ne": MessageStatus.READ}
-        },
-        {
-            "$set": {
-                "status": MessageStatus.READ,
-                "read_at": datetime.utcnow()
-            }
-        }
-    )
+    # Mark messages as read in the background, up to the newest message returned
+    if messages:
+        read_receipt_writer.enqueue(conversation, current_user.id, max(msg["created_at"] for msg in messages))
     
     return message_responses
 
@@ -1697,20 +3349,9 @@ async def mark_message_read(
     current_user: User = Depends(get_current_user)
 ):
     """Mark a specific message as read"""
-    result = await db.chat_messages.update_one(
-        {
-            "id": message_id,
-            "receiver_id": current_user.id
-        },
-        {
-            "$set": {
-                "status": MessageStatus.READ,
-                "read_at": datetime.utcnow()
-            }
-        }
-    )
+    previous = await mark_message_as_read(message_id, current_user.id)
     
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Message not found"
@@ -1718,11 +3359,348 @@ async def mark_message_read(
     
     return {"message": "Message marked as read"}
 
+# Unread counter reconciliation
+async def reconcile_unread_counts() -> int:
+    """Recompute every conversation's unread counters from chat_messages.
+
+    Counters are kept up to date incrementally; this repairs any drift left
+    by failed writes or races. Returns the number of conversations fixed.
+    """
+    # Counters are read before the messages, and each fix only applies if the
+    # counters are unchanged, so a send or read in between is never overwritten
+    conversations = await db.chat_conversations.find(
+        {}, {"_id": 0, "id": 1, "unread_counts": 1}
+    ).to_list(None)
+    
+    actual: Dict[str, Dict[str, int]] = {}
+    unread = db.chat_messages.aggregate([
+        {"$match": {"status": {"$ne": MessageStatus.READ}}},
+        {"$group": {"_id": {"conversation_id": "$conversation_id", "receiver_id": "$receiver_id"}, "count": {"$sum": 1}}}
+    ])
+    async for row in unread:
+        actual.setdefault(row["_id"]["conversation_id"], {})[row["_id"]["receiver_id"]] = row["count"]
+    
+    updates = []
+    for conv in conversations:
+        stored = {k: v for k, v in (conv.get("unread_counts") or {}).items() if v}
+        expected = actual.get(conv["id"], {})
+        if stored != expected:
+            updates.append(UpdateOne(
+                {"id": conv["id"], "unread_counts": conv.get("unread_counts")},
+                {"$set": {"unread_counts": expected}}
+            ))
+    
+    if updates:
+        await db.chat_conversations.bulk_write(updates, ordered=False)
+    return len(updates)
+
+# Upload blob garbage collection
+async def delete_upload_blob(blob_id: str, grace_cutoff: datetime) -> bool:
+    """Delete an unreferenced blob and its previews without racing new uploads.
+
+    The record is tombstoned with ``deleting_at`` and the files are moved
+    aside before the record is deleted. If an upload takes a reference in
+    the meantime, the delete doesn't match and the files are put back.
+    """
+    now = datetime.utcnow()
+    tombstoned = await db.file_blobs.update_one(
+        {
+            "id": blob_id,
+            "ref_count": {"$lte": 0},
+            # A tombstone older than the grace period was left by a crashed collector
+            "$or": [{"deleting_at": {"$exists": False}}, {"deleting_at": {"$lt": grace_cutoff}}]
+        },
+        {"$set": {"deleting_at": now}}
+    )
+    if not tombstoned.matched_count:
+        return False
+    
+    blob_path = BLOBS_DIR / blob_relative_path(blob_id)
+    moved = []
+    for path in [blob_path, *blob_path.parent.glob(f"{blob_id}.thumb-*")]:
+        trash_path = BLOB_TMP_DIR / f"{uuid.uuid4()}.deleting"
+        try:
+            path.replace(trash_path)
+        except FileNotFoundError:
+            continue
+        os.utime(trash_path)  # Keep the stray file sweep off it
+        moved.append((path, trash_path))
+    
+    deleted = await db.file_blobs.delete_one({"id": blob_id, "deleting_at": now, "ref_count": {"$lte": 0}})
+    for path, trash_path in moved:
+        if deleted.deleted_count or path.exists():
+            trash_path.unlink(missing_ok=True)
+        else:
+            trash_path.replace(path)  # Revived by an upload; content is identical
+    if not deleted.deleted_count:
+        await db.file_blobs.update_one({"id": blob_id, "deleting_at": now}, {"$unset": {"deleting_at": ""}})
+    return bool(deleted.deleted_count)
+
+async def collect_upload_blobs() -> int:
+    """Repair blob reference counts and delete unreferenced blobs.
+
+    Reference counts are recomputed from chat_messages. Blobs that have been
+    unreferenced for longer than BLOB_GC_GRACE_SECONDS are deleted, as are
+    stray files with no file_blobs entry. Returns the number of files removed.
+    """
+    now = datetime.utcnow()
+    grace_cutoff = now - timedelta(seconds=BLOB_GC_GRACE_SECONDS)
+    
+    actual: Dict[str, int] = {}
+    references = db.chat_messages.aggregate([
+        {"$match": {"file_url": {"$regex": f"^{re.escape(BLOB_URL_PREFIX)}"}}},
+        {"$group": {"_id": "$file_url", "count": {"$sum": 1}}}
+    ])
+    async for row in references:
+        actual[row["_id"]] = row["count"]
+    
+    known_ids = set()
+    updates = []
+    async for blob in db.file_blobs.find({}, {"_id": 0, "id": 1, "url": 1, "ref_count": 1, "created_at": 1, "released_at": 1}):
+        known_ids.add(blob["id"])
+        count = actual.get(blob["url"], 0)
+        # Blobs uploaded moments ago may not have their message saved yet
+        if count == blob["ref_count"] or blob.get("created_at", now) > grace_cutoff:
+            continue
+        update = {"$set": {"ref_count": count}}
+        if count == 0 and not blob.get("released_at"):
+            update["$set"]["released_at"] = now
+        updates.append(UpdateOne({"id": blob["id"], "ref_count": blob["ref_count"]}, update))
+    if updates:
+        await db.file_blobs.bulk_write(updates, ordered=False)
+    
+    removed = 0
+    expired = db.file_blobs.find(
+        {"ref_count": {"$lte": 0}, "released_at": {"$lt": grace_cutoff}}, {"_id": 0, "id": 1}
+    )
+    async for blob in expired:
+        if await delete_upload_blob(blob["id"], grace_cutoff):
+            known_ids.discard(blob["id"])
+            removed += 1
+    
+    # Stray files: blobs without an entry and abandoned temporary uploads
+    cutoff_timestamp = datetime.now().timestamp() - BLOB_GC_GRACE_SECONDS
+    for path in list(BLOBS_DIR.glob("*/*/*")) + list(BLOB_TMP_DIR.iterdir()):
+        blob_id = THUMBNAIL_SUFFIX_PATTERN.sub("", path.name)
+        if path.is_file() and blob_id not in known_ids and path.stat().st_mtime < cutoff_timestamp:
+            path.unlink(missing_ok=True)
+            removed += 1
+    
+    return removed
+
+async def run_periodically(name: str, job: Callable[[], Awaitable[int]], interval_seconds: int):
+    """Run ``job`` now and then every ``interval_seconds``, logging what it did."""
+    while True:
+        try:
+            count = await job()
+            if count:
+                logger.info(f"{name} updated {count} items")
+        except Exception as e:
+            logger.error(f"{name} failed: {e}")
+        await asyncio.sleep(interval_seconds)
+
+background_tasks: List[asyncio.Task] = []
+
+class UploadSizeLimitMiddleware:
+    """Reject uploads whose declared size is over the limit before the body is parsed.
+
+    A plain ASGI middleware, so the file responses of other routes (including
+    zero-copy sends) pass through it untouched.
+    """
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/api/chat/upload":
+            content_length = Headers(scope=scope).get("content-length")
+            # Allow some room for the multipart envelope around the file
+            if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE + 64 * 1024:
+                response = JSONResponse(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    content={"detail": "File size too large (max 10MB)"}
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # Include the router in the main app
 app.include_router(api_router)
 
 # Serve uploaded files
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+UPLOAD_CACHE_CONTROL = "private, max-age=31536000, immutable"  # Upload files are never rewritten
+UPLOAD_RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+# Types browsers may render in place; everything else is served as a download
+UPLOAD_INLINE_MEDIA_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp", "application/pdf"}
+
+class RangeFileResponse(Response):
+    """Send ``length`` bytes of a file starting at ``offset``.
+
+    Hands whole files to the server with the ASGI path-send extension and
+    ranges to the zero-copy (sendfile) extension when the server offers them,
+    and streams the file in chunks otherwise.
+    """
+    def __init__(self, path: Path, offset: int, length: int, status_code: int, headers: dict,
+                 media_type: Optional[str] = None, send_body: bool = True):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.status_code = status_code
+        self.media_type = media_type
+        self.send_body = send_body
+        self.background = None
+        self.init_headers(headers)
+    
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        
+        extensions = scope.get("extensions", {})
+        if "http.response.pathsend" in extensions and self.offset == 0 and self.length == self.path.stat().st_size:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return
+        
+        if "http.response.zerocopy" in extensions:
+            with open(self.path, "rb") as f:
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": f,
+                    "offset": self.offset,
+                    "count": self.length,
+                    "more_body": False
+                })
+            return
+        
+        async with aiofiles.open(self.path, "rb") as f:
+            await f.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                remaining = remaining - len(chunk) if chunk else 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[tuple]:
+    """Parse a single ``bytes=`` range into inclusive (start, end).
+
+    Returns None when the header should be ignored and raises ValueError
+    when the range cannot be satisfied.
+    """
+    match = UPLOAD_RANGE_PATTERN.fullmatch(range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None  # Malformed or multiple ranges; serve the whole file
+    if file_size == 0:
+        raise ValueError("Empty file")
+    start, end = match.groups()
+    if start == "":
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(file_size - length, 0), file_size - 1
+    start = int(start)
+    end = min(int(end), file_size - 1) if end else file_size - 1
+    if start >= file_size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+@app.api_route("/uploads/{file_path:path}", methods=["GET", "HEAD"])
+async def serve_upload(
+    file_path: str,
+    request: Request,
+    uid: Optional[str] = None,
+    exp: Optional[int] = None,
+    sig: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Serve an uploaded file to the participants of a conversation it was sent in.
+
+    Accepts a Bearer header, or the signed ``file_access`` query string from
+    a message response (for <img> tags), and supports ETag revalidation and
+    ranges.
+    """
+    # Thumbnails are authorized through their original file
+    file_url = f"/uploads/{file_path}"
+    thumbnail_match = THUMBNAIL_SUFFIX_PATTERN.search(file_url)
+    source_url = file_url[:thumbnail_match.start()] if thumbnail_match else file_url
+    
+    if verify_upload_access(source_url, uid, exp, sig):
+        # The signature was only issued to a participant
+        message_filter = {"file_url": source_url}
+    elif credentials:
+        # Only files sent in one of the user's conversations are visible
+        current_user = await authenticate_token(credentials.credentials)
+        message_filter = {"file_url": source_url, "$or": [{"sender_id": current_user.id}, {"receiver_id": current_user.id}]}
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    message = await db.chat_messages.find_one(message_filter, {"_id": 0, "file_name": 1, "file_hash": 1})
+    uploads_root = UPLOADS_DIR.resolve()
+    path = (uploads_root / file_path).resolve()
+    if not message or not path.is_relative_to(uploads_root) or not path.is_file():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+    
+    stat_result = path.stat()
+    file_size = stat_result.st_size
+    if message.get("file_hash"):
+        etag = f'"{message["file_hash"]}-{thumbnail_match.group(1)}"' if thumbnail_match else f'"{message["file_hash"]}"'
+    else:
+        etag = f'W/"{int(stat_result.st_mtime)}-{file_size}"'
+    
+    headers = {
+        "ETag": etag,
+        "Cache-Control": UPLOAD_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+    }
+    
+    # Revalidation
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    if thumbnail_match:
+        media_type = "image/jpeg"
+    else:
+        media_type = mimetypes.guess_type(message.get("file_name") or path.name)[0] or "application/octet-stream"
+    # Anything a browser could run (HTML, SVG, ...) is only offered as a download
+    disposition = "inline" if media_type in UPLOAD_INLINE_MEDIA_TYPES else "attachment"
+    if message.get("file_name") and not thumbnail_match:
+        headers["Content-Disposition"] = f"{disposition}; filename*=UTF-8''{quote(message['file_name'])}"
+    else:
+        headers["Content-Disposition"] = disposition
+    
+    # Byte ranges (ignored when If-Range no longer matches)
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range_header(range_header, file_size)
+        except ValueError:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={"Content-Range": f"bytes */{file_size}", **headers}
+            )
+    
+    send_body = request.method != "HEAD"
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return RangeFileResponse(path, start, end - start + 1, status.HTTP_206_PARTIAL_CONTENT,
+                                 headers, media_type, send_body)
+    
+    headers["Content-Length"] = str(file_size)
+    return RangeFileResponse(path, 0, file_size, status.HTTP_200_OK, headers, media_type, send_body)
 
 app.add_middleware(
     CORSMiddleware,
@@ -1730,6 +3708,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Before-Cursor", "X-After-Cursor"],
 )
 
 # Configure logging
@@ -1742,23 +3721,30 @@ logger = logging.getLogger(__name__)
 @app.on_event("startup")
 async def startup_db():
     """Create indexes on startup"""
-    await db.users.create_index("email", unique=True)
-    await db.doctor_profiles.create_index("user_id", unique=True)
-    await db.doctor_profiles.create_index("specializations")
-    await db.doctor_profiles.create_index("clinic_info.city")
-    await db.availability_slots.create_index([("doctor_id", 1), ("date", 1)])
-    await db.appointments.create_index([("patient_id", 1), ("appointment_date", 1)])
-    await db.appointments.create_index([("doctor_id", 1), ("appointment_date", 1)])
-    await db.appointments.create_index("availability_slot_id")
-    await db.appointments.create_index("status")
-    # Chat indexes
-    await db.chat_conversations.create_index("participants")
-    await db.chat_conversations.create_index([("last_message_at", -1)])
-    await db.chat_messages.create_index("conversation_id")
-    await db.chat_messages.create_index([("conversation_id", 1), ("created_at", 1)])
-    await db.chat_messages.create_index([("receiver_id", 1), ("status", 1)])
-    logger.info("Database indexes created")
+    created = await ensure_indexes()
+    logger.info(f"Database indexes checked, created {sum(len(names) for names in created.values())}")
+    await backfill_doctor_search_names()
+    await build_suggestion_index()
+    await manager.start()
+    await read_receipt_writer.start()
+    start_thumbnail_pool()
+    background_tasks.append(asyncio.create_task(
+        run_periodically("Unread counter reconciliation", reconcile_unread_counts, UNREAD_RECONCILE_INTERVAL_SECONDS)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("Upload blob collection", collect_upload_blobs, BLOB_GC_INTERVAL_SECONDS)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("Chat presence heartbeat", manager.check_heartbeats, PRESENCE_HEARTBEAT_SECONDS)
+    ))
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await read_receipt_writer.stop()
+    await manager.stop()
+    if thumbnail_pool:
+        thumbnail_pool.shutdown(wait=False, cancel_futures=True)
+    password_hasher.shutdown()
     client.close()
\ No newline at end of file
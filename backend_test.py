@@ -1680,6 +1680,37 @@ class HealthcareAPITester:
             token=self.tokens['doctor']
         )
 
+    def test_get_conversation_messages_with_cursor(self):
+        """Test paging back through messages with the before cursor"""
+        if 'doctor' not in self.tokens or not hasattr(self, 'test_conversation_id'):
+            print("❌ No doctor token or conversation ID found")
+            return False, {}
+        
+        self.tests_run += 1
+        print(f"\n🔍 Testing Get Messages with Cursor...")
+        
+        try:
+            headers = {'Authorization': f'Bearer {self.tokens["doctor"]}'}
+            url = f"{self.api_url}/chat/messages/{self.test_conversation_id}"
+            first_page = requests.get(f"{url}?limit=1", headers=headers)
+            cursor = first_page.headers.get('X-Before-Cursor')
+            if first_page.status_code != 200 or not cursor:
+                print(f"❌ Failed - No cursor returned (status {first_page.status_code})")
+                return False, {}
+            
+            second_page = requests.get(f"{url}?limit=1&before={cursor}", headers=headers)
+            first_ids = {m['id'] for m in first_page.json()}
+            second_ids = {m['id'] for m in second_page.json()}
+            if second_page.status_code == 200 and not first_ids & second_ids:
+                self.tests_passed += 1
+                print(f"✅ Passed - Pages do not overlap")
+                return True, second_page.json()
+            print(f"❌ Failed - Status {second_page.status_code}, overlapping ids: {first_ids & second_ids}")
+            return False, {}
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, {}
+
     def test_mark_message_as_read(self):
         """Test marking a specific message as read"""
         if 'doctor' not in self.tokens or not hasattr(self, 'test_message_id'):
@@ -1694,14 +1725,21 @@ class HealthcareAPITester:
             token=self.tokens['doctor']
         )
 
+    def chat_socket_url(self, role):
+        """Chat WebSocket URL authorized with a freshly issued ticket"""
+        response = requests.post(f"{self.api_url}/chat/ws-ticket",
+                                 headers={'Authorization': f"Bearer {self.tokens[role]}"})
+        return (f"wss://repo-explorer-64.preview.emergentagent.com/ws/chat/"
+                f"{self.users[role]['id']}?ticket={response.json().get('ticket', '')}")
+
     def test_websocket_connection(self):
         """Test WebSocket connection for real-time chat"""
-        if 'patient' not in self.users:
+        if 'patient' not in self.users or 'patient' not in self.tokens:
             print("❌ No patient user found for WebSocket test")
             return False, {}
         
         # WebSocket URL
-        ws_url = f"wss://repo-explorer-64.preview.emergentagent.com/ws/chat/{self.users['patient']['id']}"
+        ws_url = self.chat_socket_url('patient')
         
         self.tests_run += 1
         print(f"\n🔍 Testing WebSocket Connection...")
@@ -1770,6 +1808,98 @@ class HealthcareAPITester:
             print(f"❌ Failed - Error: {str(e)}")
             return False, {}
 
+    def test_websocket_rejects_missing_token(self):
+        """Test that the WebSocket handshake requires a valid token"""
+        if 'patient' not in self.users:
+            print("❌ No patient user found for WebSocket auth test")
+            return False, {}
+        
+        ws_url = f"wss://repo-explorer-64.preview.emergentagent.com/ws/chat/{self.users['patient']['id']}"
+        
+        self.tests_run += 1
+        print(f"\n🔍 Testing WebSocket Handshake Without Token...")
+        
+        try:
+            import websocket
+            
+            ws = websocket.create_connection(ws_url, timeout=10)
+            ws.close()
+            print(f"❌ Failed - Connection accepted without a token")
+            return False, {}
+        except Exception as e:
+            self.tests_passed += 1
+            print(f"✅ Passed - Handshake rejected: {str(e)}")
+            return True, {}
+
+    def test_websocket_send_message(self):
+        """Test sending a chat message over an authenticated WebSocket"""
+        if 'patient' not in self.tokens or 'doctor' not in self.users:
+            print("❌ Need patient token and doctor user for WebSocket send test")
+            return False, {}
+        
+        ws_url = self.chat_socket_url('patient')
+        
+        self.tests_run += 1
+        print(f"\n🔍 Testing WebSocket Message Send...")
+        
+        try:
+            import websocket
+            
+            ws = websocket.create_connection(ws_url, timeout=10)
+            ws.send(json.dumps({
+                "type": "send",
+                "client_id": "test-1",
+                "receiver_id": self.users['doctor']['id'],
+                "content": "Hello from the WebSocket test"
+            }))
+            reply = json.loads(ws.recv())
+            ws.close()
+            
+            if reply.get("type") == "ack" and reply.get("client_id") == "test-1" and reply.get("message", {}).get("id"):
+                self.tests_passed += 1
+                print(f"✅ Passed - Message acknowledged: {reply['message']['id']}")
+                return True, reply
+            print(f"❌ Failed - Unexpected reply: {reply}")
+            return False, reply
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, {}
+
+    def test_websocket_msgpack_subprotocol(self):
+        """Test MessagePack framing negotiated through the chat.msgpack subprotocol"""
+        if 'patient' not in self.tokens or 'doctor' not in self.users:
+            print("❌ Need patient token and doctor user for WebSocket MessagePack test")
+            return False, {}
+        
+        ws_url = self.chat_socket_url('patient')
+        
+        self.tests_run += 1
+        print(f"\n🔍 Testing WebSocket MessagePack Framing...")
+        
+        try:
+            import msgpack
+            import websocket
+            
+            ws = websocket.create_connection(ws_url, timeout=10, subprotocols=["chat.msgpack", "chat.json"])
+            ws.send_binary(msgpack.packb({
+                "type": "send",
+                "client_id": "test-msgpack",
+                "receiver_id": self.users['doctor']['id'],
+                "content": "Hello over MessagePack"
+            }))
+            reply = msgpack.unpackb(ws.recv())
+            ws.close()
+            
+            if reply.get("type") == "ack" and reply.get("client_id") == "test-msgpack":
+                self.tests_passed += 1
+                print(f"✅ Passed - MessagePack ack: {reply['message']['id']}")
+                return True, reply
+            print(f"❌ Failed - Unexpected reply: {reply}")
+            return False, reply
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, {}
+
     def test_chat_role_based_access(self):
         """Test that chat respects role-based access control"""
         all_success = True
@@ -1957,12 +2087,16 @@ def main():
     tester.test_get_doctor_conversations()
     tester.test_get_conversation_messages()
     tester.test_get_conversation_messages_with_pagination()
+    tester.test_get_conversation_messages_with_cursor()
     
     print("   ✅ Message Status Tests")
     tester.test_mark_message_as_read()
     
     print("   🔌 WebSocket Tests")
     tester.test_websocket_connection()
+    tester.test_websocket_rejects_missing_token()
+    tester.test_websocket_send_message()
+    tester.test_websocket_msgpack_subprotocol()
     
     print("   🔗 Integration Tests")
     tester.test_chat_integration_with_appointments()
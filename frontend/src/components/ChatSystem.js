@@ -31,6 +31,9 @@ import {
     Video
 } from 'lucide-react';
 
+// Chat events arrive as binary frames of UTF-8 JSON
+const textDecoder = new TextDecoder();
+
 const ChatSystem = ({ 
     currentUser, 
     API, 
@@ -52,6 +55,8 @@ const ChatSystem = ({
     const messagesEndRef = useRef(null);
     const fileInputRef = useRef(null);
     const wsRef = useRef(null);
+    const pendingAcksRef = useRef(new Map());
+    const heartbeatRef = useRef(null);
     
     // Scroll to bottom of messages
     const scrollToBottom = useCallback(() => {
@@ -62,25 +67,70 @@ const ChatSystem = ({
     useEffect(() => {
         if (!currentUser) return;
 
-        const connectWebSocket = () => {
-            const wsUrl = `wss://${window.location.host}/ws/chat/${currentUser.id}`;
-            
+        const connectWebSocket = async () => {
             try {
+                // Sockets authenticate with a short-lived ticket so the access
+                // token never appears in a URL
+                const response = await axios.post(`${API}/chat/ws-ticket`, {}, {
+                    headers: { Authorization: `Bearer ${localStorage.getItem('token')}` }
+                });
+                const ticket = encodeURIComponent(response.data.ticket);
+                const wsUrl = `wss://${window.location.host}/ws/chat/${currentUser.id}?ticket=${ticket}&binary=1`;
+                
                 wsRef.current = new WebSocket(wsUrl);
+                wsRef.current.binaryType = 'arraybuffer';
                 
                 wsRef.current.onopen = () => {
                     console.log('Chat WebSocket connected');
                     setIsOnline(true);
+                    // Keep our presence alive while the tab is open
+                    clearInterval(heartbeatRef.current);
+                    heartbeatRef.current = setInterval(() => {
+                        if (wsRef.current?.readyState === WebSocket.OPEN) {
+                            wsRef.current.send(JSON.stringify({ type: 'ping' }));
+                        }
+                    }, 30000);
                 };
                 
                 wsRef.current.onmessage = (event) => {
                     try {
-                        const data = JSON.parse(event.data);
+                        const data = JSON.parse(
+                            typeof event.data === 'string' ? event.data : textDecoder.decode(event.data)
+                        );
                         
-                        if (data.type === 'new_message') {
+                        if ((data.type === 'ack' || data.type === 'error') && data.client_id) {
+                            const pending = pendingAcksRef.current.get(data.client_id);
+                            if (pending) {
+                                pendingAcksRef.current.delete(data.client_id);
+                                clearTimeout(pending.timer);
+                                if (data.type === 'ack') {
+                                    pending.resolve(data);
+                                } else {
+                                    pending.reject(new Error(data.detail));
+                                }
+                            }
+                        } else if (data.type === 'new_message') {
                             handleNewMessage(data.message);
+                        } else if (data.type === 'thumbnails_ready') {
+                            setMessages(prev => prev.map(message => (
+                                message.id === data.message_id
+                                    ? { ...message, thumbnail_urls: data.thumbnail_urls }
+                                    : message
+                            )));
+                        } else if (data.type === 'presence') {
+                            const applyPresence = (conversation) => (
+                                conversation?.participants?.includes(data.user_id)
+                                    ? {
+                                        ...conversation,
+                                        other_participant_online: data.online,
+                                        other_participant_last_seen: data.last_seen
+                                    }
+                                    : conversation
+                            );
+                            setConversations(prev => prev.map(applyPresence));
+                            setSelectedConversation(prev => applyPresence(prev));
                         } else if (data.type === 'typing') {
-                            setIsTyping(data.isTyping);
+                            setIsTyping(data.is_typing);
                         }
                     } catch (error) {
                         console.error('Error parsing WebSocket message:', error);
@@ -90,6 +140,7 @@ const ChatSystem = ({
                 wsRef.current.onclose = () => {
                     console.log('Chat WebSocket disconnected');
                     setIsOnline(false);
+                    clearInterval(heartbeatRef.current);
                     // Attempt to reconnect after 3 seconds
                     setTimeout(connectWebSocket, 3000);
                 };
@@ -109,11 +160,31 @@ const ChatSystem = ({
         connectWebSocket();
 
         return () => {
+            clearInterval(heartbeatRef.current);
             if (wsRef.current) {
                 wsRef.current.close();
             }
         };
-    }, [currentUser]);
+    }, [currentUser, API]);
+
+    // Send a frame over the chat socket and wait for its ack.
+    // Resolves to null when the socket isn't open so callers can fall back to REST.
+    const sendSocketFrame = useCallback((frame) => {
+        const ws = wsRef.current;
+        if (!ws || ws.readyState !== WebSocket.OPEN) {
+            return Promise.resolve(null);
+        }
+
+        const clientId = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+        return new Promise((resolve, reject) => {
+            const timer = setTimeout(() => {
+                pendingAcksRef.current.delete(clientId);
+                reject(new Error('Timed out waiting for server acknowledgement'));
+            }, 10000);
+            pendingAcksRef.current.set(clientId, { resolve, reject, timer });
+            ws.send(JSON.stringify({ ...frame, client_id: clientId }));
+        });
+    }, []);
 
     // Handle new incoming message
     const handleNewMessage = useCallback((message) => {
@@ -178,15 +249,23 @@ const ChatSystem = ({
         
         setIsSending(true);
         try {
-            const response = await axios.post(`${API}/chat/send`, {
+            const payload = {
                 receiver_id: selectedConversation.participants.find(p => p !== currentUser.id),
                 message_type: 'text',
                 content: newMessage.trim()
-            }, {
-                headers: { Authorization: `Bearer ${localStorage.getItem('token')}` }
-            });
+            };
+
+            // Prefer the open chat socket; fall back to the REST endpoint
+            const ack = await sendSocketFrame({ type: 'send', ...payload });
+            let sentMessage = ack && ack.message;
+            if (!sentMessage) {
+                const response = await axios.post(`${API}/chat/send`, payload, {
+                    headers: { Authorization: `Bearer ${localStorage.getItem('token')}` }
+                });
+                sentMessage = response.data;
+            }
             
-            setMessages(prev => [...prev, response.data]);
+            setMessages(prev => [...prev, sentMessage]);
             setNewMessage('');
             fetchConversations(); // Update conversation list
             setTimeout(scrollToBottom, 100);
@@ -249,6 +328,9 @@ const ChatSystem = ({
     // Mark message as read
     const markMessageAsRead = async (messageId) => {
         try {
+            const ack = await sendSocketFrame({ type: 'read', message_id: messageId });
+            if (ack) return;
+
             await axios.put(`${API}/chat/messages/${messageId}/read`, {}, {
                 headers: { Authorization: `Bearer ${localStorage.getItem('token')}` }
             });
@@ -368,7 +450,7 @@ const ChatSystem = ({
                                     {/* Chat Header */}
                                     <AnimatedChatHeader
                                         conversation={selectedConversation}
-                                        isOnline={isOnline}
+                                        isOnline={isOnline && selectedConversation.other_participant_online}
                                         onBack={() => setSelectedConversation(null)}
                                     />
 
@@ -119,7 +119,7 @@ export const AnimatedChatMessage = ({ message, isOwnMessage, isLatest }) => {
                         <div className="space-y-2">
                             <div className="relative rounded-lg overflow-hidden bg-gray-100">
                                 <img 
-                                    src={`${process.env.REACT_APP_BACKEND_URL}${message.file_url}`}
+                                    src={`${process.env.REACT_APP_BACKEND_URL}${message.thumbnail_urls?.medium || message.file_url}?${message.file_access || ''}`}
                                     alt={message.file_name}
                                     className="max-w-full h-auto max-h-48 object-contain"
                                 />
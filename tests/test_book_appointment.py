@@ -0,0 +1,105 @@
+import asyncio
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+SLOT_DATE = datetime(2030, 1, 7)
+
+
+@pytest.fixture
+def slot(monkeypatch):
+    monkeypatch.setattr(server, "db", mongomock_motor.AsyncMongoMockClient()["test_database"])
+    doctor = server.User(email="doctor@example.com", name="Grey", role=server.UserRole.DOCTOR)
+    slot = server.AvailabilitySlot(
+        doctor_id=doctor.id, date=SLOT_DATE, start_time="09:00", end_time="09:30",
+        consultation_type=server.ConsultationType.ONLINE
+    )
+    asyncio.run(server.db.users.insert_one(doctor.dict()))
+    asyncio.run(server.db.availability_slots.insert_one(slot.dict()))
+    return slot
+
+
+def make_patient(name):
+    return server.User(email=f"{name}@example.com", name=name, role=server.UserRole.PATIENT)
+
+
+def booking(slot, **overrides):
+    return server.AppointmentCreate(**{
+        "doctor_id": slot.doctor_id,
+        "availability_slot_id": slot.id,
+        "consultation_type": server.ConsultationType.ONLINE,
+        "appointment_date": SLOT_DATE.replace(hour=9),
+        "start_time": slot.start_time,
+        "end_time": slot.end_time,
+        **overrides
+    })
+
+
+async def slot_status(slot):
+    return (await server.db.availability_slots.find_one({"id": slot.id}))["status"]
+
+
+def test_concurrent_claims_book_the_slot_once(slot, monkeypatch):
+    collection_class = type(server.db.availability_slots)
+    find_one_and_update = collection_class.find_one_and_update
+
+    async def yielding_find_one_and_update(self, *args, **kwargs):
+        await asyncio.sleep(0)  # Let the other booking reach its claim too
+        return await find_one_and_update(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection_class, "find_one_and_update", yielding_find_one_and_update)
+
+    async def scenario():
+        results = await asyncio.gather(
+            server.book_appointment(booking(slot), make_patient("alice")),
+            server.book_appointment(booking(slot), make_patient("bob")),
+            return_exceptions=True
+        )
+        booked = [r for r in results if isinstance(r, server.AppointmentResponse)]
+        rejected = [r for r in results if isinstance(r, HTTPException)]
+        assert len(booked) == 1 and len(rejected) == 1
+        assert rejected[0].status_code == 404
+        assert booked[0].doctor_name == "Grey"
+        assert await slot_status(slot) == server.AvailabilityStatus.BOOKED
+        assert await server.db.appointments.count_documents({}) == 1
+
+    asyncio.run(scenario())
+
+
+def test_mismatched_details_leave_the_slot_available(slot):
+    async def scenario():
+        with pytest.raises(HTTPException) as error:
+            await server.book_appointment(booking(slot, start_time="10:00"), make_patient("alice"))
+        assert error.value.status_code == 400
+        assert await slot_status(slot) == server.AvailabilityStatus.AVAILABLE
+
+    asyncio.run(scenario())
+
+
+def test_failed_booking_releases_the_slot(slot):
+    async def scenario():
+        patient = make_patient("alice")
+        # The patient already has an appointment at this time with another doctor
+        await server.db.appointments.insert_one(server.Appointment(
+            **booking(slot, doctor_id="other-doctor", availability_slot_id="other-slot").dict(),
+            patient_id=patient.id
+        ).dict())
+
+        with pytest.raises(HTTPException) as error:
+            await server.book_appointment(booking(slot), patient)
+        assert error.value.status_code == 400
+        assert await slot_status(slot) == server.AvailabilityStatus.AVAILABLE
+
+    asyncio.run(scenario())
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class FakeWebSocket:
+    """Records the frames a ConnectionManager writes to a socket."""
+    def __init__(self):
+        self.frames = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        self.frames.append(server.decode_ws_message(data))
+
+    async def send_bytes(self, data):
+        self.frames.append(server.decode_ws_message(data))
+
+    async def close(self, code=1000):
+        pass
+
+
+def make_user(name):
+    return server.User(email=f"{name}@example.com", name=name, role=server.UserRole.PATIENT)
+
+
+async def open_socket(manager, user):
+    websocket = FakeWebSocket()
+    await manager.connect(server.ChatConnection(websocket, user))
+    return websocket
+
+
+async def settle():
+    # Let the connection writer tasks drain their queues
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_local_broker_fans_out_between_managers():
+    async def scenario():
+        broker = server.LocalBroker()
+        first, second = server.ConnectionManager(broker), server.ConnectionManager(broker)
+        await first.start()
+        await second.start()
+        alice, bob = make_user("alice"), make_user("bob")
+        alice_here = await open_socket(first, alice)
+        alice_there = await open_socket(second, alice)
+        bob_there = await open_socket(second, bob)
+
+        await first.send_personal_message({"type": "new_message", "text": "hi"}, alice.id)
+        await settle()
+
+        assert alice_here.frames == [{"type": "new_message", "text": "hi"}]
+        assert alice_there.frames == [{"type": "new_message", "text": "hi"}]
+        assert bob_there.frames == []
+
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_local_broker_relays_user_changes_to_other_managers():
+    async def scenario():
+        broker = server.LocalBroker()
+        first, second = server.ConnectionManager(broker), server.ConnectionManager(broker)
+        await first.start()
+        await second.start()
+        alice = make_user("alice")
+        connection = server.ChatConnection(FakeWebSocket(), alice)
+        await second.connect(connection)
+
+        renamed = server.User(**{**alice.dict(), "name": "Alice Smith"})
+        await first.user_changed(renamed)
+
+        assert connection.user.name == "Alice Smith"
+
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class StalledWebSocket:
+    """A socket whose client never reads, so sends never complete."""
+    def __init__(self):
+        self.closed_with = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        await asyncio.Event().wait()
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+class SlowPresence:
+    """Presence registry whose writes take a while, like a slow database."""
+    def __init__(self):
+        self.offline = []
+
+    async def touch_worker(self, worker_id):
+        pass
+
+    async def remove_worker(self, worker_id):
+        pass
+
+    async def mark_online(self, user_id, worker_id):
+        return False
+
+    async def mark_offline(self, user_id, worker_id):
+        await asyncio.sleep(0.05)
+        self.offline.append(user_id)
+        return None
+
+
+def make_connection(queue_size=2):
+    user = server.User(email="alice@example.com", name="alice", role=server.UserRole.PATIENT)
+    return server.ChatConnection(StalledWebSocket(), user, queue_size=queue_size)
+
+
+def test_unknown_overflow_policy_is_rejected():
+    with pytest.raises(ValueError):
+        server.ConnectionManager(overflow_policy="drop-newest")
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    async def scenario():
+        connection = make_connection()
+        for n in range(4):
+            assert connection.enqueue(server.WsPayload({"n": n}), "drop_oldest")
+        assert connection.dropped == 2
+        assert connection.stats()["queued"] == 2
+        frames = [(await connection.next_frame())[1].encode("json") for _ in range(2)]
+        assert frames == [server.encode_ws_message({"n": 2}), server.encode_ws_message({"n": 3})]
+        assert connection.stats()["lag_ms"] == 0.0
+
+    asyncio.run(scenario())
+
+
+def test_oldest_queued_frame_sets_the_lag():
+    async def scenario():
+        connection = make_connection()
+        connection.enqueue(server.WsPayload({"n": 1}))
+        await asyncio.sleep(0.02)
+        connection.enqueue(server.WsPayload({"n": 2}))
+        assert connection.stats()["lag_ms"] >= 20
+
+    asyncio.run(scenario())
+
+
+def test_overflow_disconnect_does_not_wait_for_presence():
+    async def scenario():
+        presence = SlowPresence()
+        manager = server.ConnectionManager(presence=presence, overflow_policy="disconnect")
+        connection = make_connection(queue_size=1)
+        await manager.connect(connection)
+        await asyncio.sleep(0)  # Let the writer take the first frame and stall
+
+        for n in range(3):
+            await manager.send(connection, server.WsPayload({"n": n}))
+        # The socket is dropped at once, but presence hasn't been written yet
+        assert connection.user_id not in manager.active_connections
+        assert manager.overflow_disconnects == 1
+        assert presence.offline == []
+
+        await asyncio.sleep(0.1)
+        assert presence.offline == [connection.user_id]
+        assert connection.websocket.closed_with == 1013
+
+    asyncio.run(scenario())
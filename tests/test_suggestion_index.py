@@ -0,0 +1,93 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+def test_set_source_indexes_every_word():
+    index = server.SuggestionIndex()
+    index.set_source("profile:1", ["Cardiology", "New York"])
+
+    assert index.search("card") == ["Cardiology"]
+    assert index.search("york") == ["New York"]
+    assert index.search("NEW") == ["New York"]
+    assert index.search("derm") == []
+
+
+def test_replacing_a_source_drops_its_old_suggestions():
+    index = server.SuggestionIndex()
+    index.set_source("profile:1", ["Cardiology", "Boston"])
+    index.set_source("profile:1", ["Cardiology", "Chicago"])
+
+    assert index.search("bos") == []
+    assert index.search("chi") == ["Chicago"]
+    assert index.search("card") == ["Cardiology"]
+
+
+def test_removing_a_source():
+    index = server.SuggestionIndex()
+    index.set_source("user:1", ["Dr. Jane Doe"])
+    index.remove_source("user:1")
+
+    assert index.search("jane") == []
+    assert index._keys == []
+    assert index._refcounts == {}
+    assert index._sources == {}
+
+
+def test_shared_suggestion_is_kept_until_its_last_source_goes():
+    index = server.SuggestionIndex()
+    index.set_source("profile:1", ["Cardiology"])
+    index.set_source("profile:2", ["Cardiology", "Dermatology"])
+    assert index._refcounts["Cardiology"] == 2
+    assert index._keys.count(("cardiology", "Cardiology")) == 1
+
+    index.remove_source("profile:1")
+    assert index._refcounts["Cardiology"] == 1
+    assert index.search("card") == ["Cardiology"]
+
+    index.set_source("profile:2", ["Dermatology"])
+    assert "Cardiology" not in index._refcounts
+    assert index.search("card") == []
+    assert index.search("derm") == ["Dermatology"]
+
+
+def test_suggestion_changes_are_broadcast_to_other_workers(monkeypatch):
+    async def scenario():
+        broker = server.LocalBroker()
+        events = []
+
+        async def deliver(user_id, payload):
+            pass
+
+        async def control(event):
+            events.append(event)
+
+        await broker.start("other-worker", deliver, control)
+        manager = server.ConnectionManager(broker)
+        await manager.start()
+        monkeypatch.setattr(server, "manager", manager)
+        monkeypatch.setattr(server, "suggestion_index", server.SuggestionIndex())
+
+        await server.index_doctor_profile_suggestions(
+            {"user_id": "1", "specializations": ["Neurology"], "clinic_info": {"city": "Austin"}}
+        )
+        assert server.suggestion_index.search("neuro") == ["Neurology"]
+        assert events == [
+            {"type": "suggestions_changed", "source_id": "profile:1", "suggestions": ["Neurology", "Austin"]}
+        ]
+
+        # A worker receiving the event applies it to its own index
+        monkeypatch.setattr(server, "suggestion_index", server.SuggestionIndex())
+        await manager._handle_control(events[0])
+        assert server.suggestion_index.search("aus") == ["Austin"]
+
+        await manager.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+CONTENT = b"hello blob store"
+LONG_AGO = datetime.utcnow() - timedelta(days=1)
+
+
+@pytest.fixture
+def blobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "db", mongomock_motor.AsyncMongoMockClient()["test_database"])
+    monkeypatch.setattr(server, "BLOBS_DIR", tmp_path / "blobs")
+    monkeypatch.setattr(server, "BLOB_TMP_DIR", tmp_path / "tmp")
+    server.BLOBS_DIR.mkdir()
+    server.BLOB_TMP_DIR.mkdir()
+
+    async def save_multipart_upload(request, destination):
+        destination.write_bytes(CONTENT)
+        return "note.txt", len(CONTENT), hashlib.sha256(CONTENT).hexdigest()
+
+    monkeypatch.setattr(server, "save_multipart_upload", save_multipart_upload)
+    return tmp_path
+
+
+def blob_path(blob_id):
+    return server.BLOBS_DIR / server.blob_relative_path(blob_id)
+
+
+async def store_released_blob():
+    """Store a blob and make it look unreferenced for longer than the grace period."""
+    blob = await server.store_upload_blob(None)
+    await server.db.file_blobs.update_one(
+        {"id": blob["id"]},
+        {"$set": {"ref_count": 0, "released_at": LONG_AGO, "created_at": LONG_AGO}}
+    )
+    return blob
+
+
+def run_once_after(monkeypatch, method_name, hook):
+    """Run ``hook`` right after the next call to a collection method."""
+    collection_class = type(server.db.file_blobs)
+    original = getattr(collection_class, method_name)
+
+    async def wrapper(self, *args, **kwargs):
+        monkeypatch.setattr(collection_class, method_name, original)
+        result = await original(self, *args, **kwargs)
+        await hook()
+        return result
+
+    monkeypatch.setattr(collection_class, method_name, wrapper)
+
+
+def run_once_before(monkeypatch, method_name, hook):
+    """Run ``hook`` right before the next call to a collection method."""
+    collection_class = type(server.db.file_blobs)
+    original = getattr(collection_class, method_name)
+
+    async def wrapper(self, *args, **kwargs):
+        monkeypatch.setattr(collection_class, method_name, original)
+        await hook()
+        return await original(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection_class, method_name, wrapper)
+
+
+async def blob_record(blob_id):
+    return await server.db.file_blobs.find_one({"id": blob_id}, {"_id": 0})
+
+
+def test_duplicate_uploads_share_one_blob(blobs):
+    async def scenario():
+        first = await server.store_upload_blob(None)
+        second = await server.store_upload_blob(None)
+        assert first["id"] == second["id"] == f"{hashlib.sha256(CONTENT).hexdigest()}.txt"
+        assert (await blob_record(first["id"]))["ref_count"] == 2
+        assert blob_path(first["id"]).read_bytes() == CONTENT
+        assert list(server.BLOB_TMP_DIR.iterdir()) == []
+
+    asyncio.run(scenario())
+
+
+def test_collection_deletes_released_blobs(blobs):
+    async def scenario():
+        blob = await store_released_blob()
+        assert await server.collect_upload_blobs() == 1
+        assert await blob_record(blob["id"]) is None
+        assert not blob_path(blob["id"]).exists()
+        assert list(server.BLOB_TMP_DIR.iterdir()) == []
+
+    asyncio.run(scenario())
+
+
+def test_upload_before_delete_revives_the_blob(blobs, monkeypatch):
+    async def scenario():
+        blob = await store_released_blob()
+        # The upload lands after the files were moved aside, before the record is deleted
+        run_once_before(monkeypatch, "delete_one", lambda: server.store_upload_blob(None))
+
+        assert await server.collect_upload_blobs() == 0
+        record = await blob_record(blob["id"])
+        assert record["ref_count"] == 1
+        assert "deleting_at" not in record
+        assert blob_path(blob["id"]).read_bytes() == CONTENT
+        assert list(server.BLOB_TMP_DIR.iterdir()) == []
+
+    asyncio.run(scenario())
+
+
+def test_upload_after_tombstone_revives_the_blob(blobs, monkeypatch):
+    async def scenario():
+        blob = await store_released_blob()
+        # The upload lands right after the tombstone, before the files are moved
+        run_once_after(monkeypatch, "update_one", lambda: server.store_upload_blob(None))
+
+        assert await server.delete_upload_blob(blob["id"], datetime.utcnow() - timedelta(hours=1)) is False
+        record = await blob_record(blob["id"])
+        assert record["ref_count"] == 1
+        assert "deleting_at" not in record
+        assert blob_path(blob["id"]).read_bytes() == CONTENT
+        assert list(server.BLOB_TMP_DIR.iterdir()) == []
+
+    asyncio.run(scenario())
+
+
+def test_fresh_tombstone_is_left_to_its_collector(blobs):
+    async def scenario():
+        blob = await store_released_blob()
+        await server.db.file_blobs.update_one({"id": blob["id"]}, {"$set": {"deleting_at": datetime.utcnow()}})
+
+        assert await server.delete_upload_blob(blob["id"], datetime.utcnow() - timedelta(hours=1)) is False
+        assert blob_path(blob["id"]).exists()
+
+        # A tombstone older than the grace period was left by a crashed collector
+        assert await server.delete_upload_blob(blob["id"], datetime.utcnow() + timedelta(seconds=1)) is True
+        assert await blob_record(blob["id"]) is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "db", mongomock_motor.AsyncMongoMockClient()["test_database"])
+    monkeypatch.setattr(server, "UPLOADS_DIR", tmp_path)
+    (tmp_path / "report.pdf").write_bytes(CONTENT)
+    (tmp_path / "page.html").write_bytes(b"<script>alert(1)</script>")
+    asyncio.run(server.db.chat_messages.insert_many([
+        {"id": "m1", "sender_id": "alice", "receiver_id": "bob", "file_url": "/uploads/report.pdf",
+         "file_name": "report.pdf", "file_hash": "abc123"},
+        {"id": "m2", "sender_id": "alice", "receiver_id": "bob", "file_url": "/uploads/page.html",
+         "file_name": "page.html", "file_hash": "def456"},
+    ]))
+    return tmp_path
+
+
+def get(file_url, headers=None, extensions=None, signed=True):
+    """Call the app directly and return (status, headers, body, messages)."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": file_url,
+        "raw_path": file_url.encode(),
+        "root_path": "",
+        "query_string": server.sign_upload_access(file_url, "bob").encode() if signed else b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": ("127.0.0.1", 1234),
+        "server": ("testserver", 80),
+        "extensions": extensions or {},
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(server.app(scope, receive, send))
+    start = messages[0]
+    response_headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], response_headers, body, messages
+
+
+def test_parse_range_header():
+    assert server.parse_range_header("bytes=0-99", 1000) == (0, 99)
+    assert server.parse_range_header("bytes=900-", 1000) == (900, 999)
+    assert server.parse_range_header("bytes=-100", 1000) == (900, 999)
+    assert server.parse_range_header("bytes=-5000", 1000) == (0, 999)
+    assert server.parse_range_header("bytes=990-2000", 1000) == (990, 999)
+    assert server.parse_range_header("bytes=0-1,5-9", 1000) is None
+    assert server.parse_range_header("items=0-1", 1000) is None
+    assert server.parse_range_header("bytes=-", 1000) is None
+    for unsatisfiable in ("bytes=1000-", "bytes=5-1", "bytes=-0"):
+        with pytest.raises(ValueError):
+            server.parse_range_header(unsatisfiable, 1000)
+    with pytest.raises(ValueError):
+        server.parse_range_header("bytes=0-", 0)
+
+
+def test_serves_whole_file_with_validators(uploads):
+    status, headers, body, _ = get("/uploads/report.pdf")
+    assert status == 200
+    assert body == CONTENT
+    assert headers["etag"] == '"abc123"'
+    assert headers["content-length"] == str(len(CONTENT))
+    assert headers["x-content-type-options"] == "nosniff"
+    assert headers["content-disposition"].startswith("inline;")
+
+
+def test_rejects_unsigned_requests(uploads):
+    status, _, _, _ = get("/uploads/report.pdf", signed=False)
+    assert status == 401
+
+
+def test_active_content_is_only_served_as_attachment(uploads):
+    status, headers, _, _ = get("/uploads/page.html")
+    assert status == 200
+    assert headers["content-disposition"].startswith("attachment;")
+    assert headers["x-content-type-options"] == "nosniff"
+
+
+def test_matching_etag_is_not_modified(uploads):
+    status, headers, body, _ = get("/uploads/report.pdf", {"If-None-Match": '"other", "abc123"'})
+    assert status == 304
+    assert body == b""
+    assert headers["etag"] == '"abc123"'
+
+
+def test_range_returns_partial_content(uploads):
+    status, headers, body, _ = get("/uploads/report.pdf", {"Range": "bytes=10-19"})
+    assert status == 206
+    assert body == CONTENT[10:20]
+    assert headers["content-range"] == f"bytes 10-19/{len(CONTENT)}"
+    assert headers["content-length"] == "10"
+
+
+def test_stale_if_range_returns_whole_file(uploads):
+    status, _, body, _ = get("/uploads/report.pdf", {"Range": "bytes=10-19", "If-Range": '"old"'})
+    assert status == 200
+    assert body == CONTENT
+
+
+def test_unsatisfiable_range(uploads):
+    status, headers, _, _ = get("/uploads/report.pdf", {"Range": f"bytes={len(CONTENT)}-"})
+    assert status == 416
+    assert headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+
+def test_whole_file_uses_pathsend(uploads):
+    status, _, _, messages = get("/uploads/report.pdf", extensions={"http.response.pathsend": {}})
+    assert status == 200
+    assert messages[1] == {"type": "http.response.pathsend", "path": str(uploads / "report.pdf")}
+
+
+def test_range_uses_zerocopy(uploads):
+    status, _, _, messages = get("/uploads/report.pdf", {"Range": "bytes=10-19"},
+                                 extensions={"http.response.zerocopy": {}})
+    assert status == 206
+    zerocopy = messages[1]
+    assert zerocopy["type"] == "http.response.zerocopy"
+    assert (zerocopy["offset"], zerocopy["count"], zerocopy["more_body"]) == (10, 10, False)